@@ -0,0 +1,64 @@
+"""
+Micro-benchmark for rendering the table rows of a contextual diff.
+
+The context diff of a large text with many scattered changes is calculated
+once, then only the rendering of its rows is timed, both straight from Python
+(the default) and through the wikify/contextual_diff_tr.html template.
+
+Run from the repository root:
+
+    $ PYTHONPATH=src:. python benchmarks/diff_rows_benchmark.py
+"""
+
+import optparse
+import os
+import time
+
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'benchmarks.settings')
+
+from django.conf import settings
+from django.template import Context
+
+from benchmarks.side_by_side_benchmark import make_texts
+from wikify.diff_utils import side_by_side_diff, context_diff
+from wikify.templatetags.diff import render_diff_rows
+
+def time_rendering(hunks, repeat, rows_template=None):
+    """Returns the best time for rendering the rows of the hunks."""
+    settings.WIKIFY_DIFF_ROWS_TEMPLATE = rows_template
+    try:
+        timings = []
+        for _ in range(repeat):
+            start = time.time()
+            u''.join(render_diff_rows(hunks, False, Context()))
+            timings.append(time.time() - start)
+    finally:
+        settings.WIKIFY_DIFF_ROWS_TEMPLATE = None
+    return min(timings)
+
+def main():
+    parser = optparse.OptionParser()
+    parser.add_option('--lines', type='int', default=20000,
+                      help="number of lines in the text")
+    parser.add_option('--changes', type='int', default=2000,
+                      help="number of changed lines")
+    parser.add_option('--repeat', type='int', default=5,
+                      help="number of runs, the best one is reported")
+    options, _ = parser.parse_args()
+
+    old_text, new_text = make_texts(options.lines, options.changes)
+    # Without a time limit, so rows show changes refined within lines
+    diff = side_by_side_diff(old_text, new_text, timeout=0)
+    if diff.degraded:
+        raise AssertionError("Diff was degraded to whole lines")
+    hunks = list(context_diff(diff))
+    row_count = sum(len(lines) + 1 for _, _, lines in hunks)
+
+    for name, rows_template in [('python', None),
+                                ('template', 'wikify/contextual_diff_tr.html')]:
+        best = time_rendering(hunks, options.repeat, rows_template)
+        print "%-8s %d rows: %.1f ms (%d rows/s)" % (
+            name, row_count, best * 1000, row_count / best)
+
+if __name__ == '__main__':
+    main()
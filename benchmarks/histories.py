@@ -0,0 +1,101 @@
+"""
+Synthetic page histories for the benchmarks.
+
+Histories are written straight to reversion's tables in batches, as creating
+many thousand revisions through the revision context manager takes too long.
+"""
+
+import datetime
+import json
+import random
+
+from django.contrib.contenttypes.models import ContentType
+from django.utils import timezone
+from reversion.models import Revision, Version, VERSION_ADD, VERSION_CHANGE
+
+from benchmarks.models import Page
+
+LINE_LENGTH = 64
+
+BATCH_SIZE = 100
+
+WORDS = ("lorem ipsum dolor sit amet consectetur adipiscing elit sed do "
+         "eiusmod tempor <incididunt> ut labore & dolore magna aliqua").split()
+
+def random_line(rnd):
+    words = []
+    length = 0
+    while length < LINE_LENGTH:
+        word = rnd.choice(WORDS)
+        words.append(word)
+        length += len(word) + 1
+    return ' '.join(words)[:LINE_LENGTH - 1]
+
+def make_text(rnd, size):
+    """Creates a text of roughly the given size in bytes."""
+    return [random_line(rnd) for _ in range(max(1, size // LINE_LENGTH))]
+
+def edit_text(rnd, lines, change_count=3):
+    """Returns a copy of the lines with some lines changed or inserted."""
+    lines = list(lines)
+    for _ in range(change_count):
+        idx = rnd.randrange(len(lines))
+        if rnd.random() < 0.7:
+            words = lines[idx].split(' ')
+            words[rnd.randrange(len(words))] = rnd.choice(WORDS)
+            lines[idx] = ' '.join(words)
+        else:
+            lines.insert(idx, random_line(rnd))
+            del lines[-1]
+    return lines
+
+def serialize(title, content):
+    """Serializes a page the way reversion's json format does."""
+    return json.dumps([{'pk': title,
+                        'model': 'benchmarks.page',
+                        'fields': {'content': content}}])
+
+def next_id(model):
+    ids = model.objects.order_by('-id').values_list('id', flat=True)[:1]
+    return (list(ids) or [0])[0] + 1
+
+def make_history(title, version_count, page_size, seed=0):
+    """
+    Creates a page with the given number of versions and returns the texts of
+    its last two versions.
+    """
+    rnd = random.Random(seed)
+    content_type = ContentType.objects.get_for_model(Page)
+    first_revision_id = next_id(Revision)
+    first_version_id = next_id(Version)
+    start_date = timezone.now() - datetime.timedelta(minutes=version_count)
+
+    lines = make_text(rnd, page_size)
+    texts = []
+    revisions, versions = [], []
+    for idx in range(version_count):
+        if idx:
+            lines = edit_text(rnd, lines)
+        text = '\n'.join(lines)
+        texts = (texts + [text])[-2:]
+
+        revision_id = first_revision_id + idx
+        revisions.append(Revision(
+                    id=revision_id,
+                    date_created=start_date + datetime.timedelta(minutes=idx),
+                    comment='Version %d' % idx))
+        versions.append(Version(id=first_version_id + idx,
+                                revision_id=revision_id,
+                                object_id=title,
+                                content_type=content_type,
+                                format='json',
+                                serialized_data=serialize(title, text),
+                                object_repr=title,
+                                type=VERSION_CHANGE if idx else VERSION_ADD))
+        if len(revisions) == BATCH_SIZE or idx == version_count - 1:
+            Revision.objects.bulk_create(revisions)
+            Version.objects.bulk_create(versions)
+            revisions, versions = [], []
+
+    Page.objects.create(title=title, content=texts[-1])
+    return texts[0] if len(texts) > 1 else '', texts[-1]
@@ -0,0 +1,12 @@
+from django.db import models
+import reversion
+
+class Page(models.Model):
+    """Wiki page model the benchmark histories are built for."""
+    title = models.CharField(max_length=255, primary_key=True)
+    content = models.TextField(blank=True)
+
+    def __unicode__(self):
+        return self.title
+
+reversion.register(Page)
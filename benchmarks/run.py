@@ -0,0 +1,158 @@
+"""
+Benchmarks for the diff functions, the diff template tag and the wiki views.
+
+Each scenario builds a synthetic page history with a number of versions of a
+given page size. Results are written as JSON, so they can be compared between
+releases. Run from the repository root:
+
+    $ PYTHONPATH=src:. python -m benchmarks.run [--full] [--output FILE]
+
+Scenarios are given as VERSIONS:PAGE_SIZE, e.g. ``--scenario 1000:10240``.
+"""
+
+import datetime
+import json
+import optparse
+import os
+import platform
+import sys
+import time
+
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'benchmarks.settings')
+
+import django
+from django.conf import settings
+from django.db import connection, reset_queries
+from django.template import Template, Context
+from django.test.client import Client
+from django.test.utils import setup_test_environment
+from reversion.models import Version
+
+from benchmarks.histories import make_history
+from wikify.diff_utils import side_by_side_diff, context_diff
+
+KB = 1024
+MB = 1024 * KB
+
+DEFAULT_SCENARIOS = [(10, 1 * KB), (100, 10 * KB), (1000, 1 * KB)]
+
+FULL_SCENARIOS = [(10, 1 * KB), (10, 1 * MB), (100, 100 * KB),
+                  (1000, 10 * KB), (10000, 1 * KB), (100000, 1 * KB)]
+
+DIFF_TEMPLATE = Template("{% load diff %}"
+                         "{% context_diff_tr old_text new_text %}")
+
+def measure(func, repeat):
+    """Calls func repeatedly and returns timings and the query count."""
+    timings = []
+    settings.DEBUG = True
+    try:
+        for _ in range(repeat):
+            reset_queries()
+            start = time.time()
+            func()
+            timings.append(time.time() - start)
+        queries = len(connection.queries)
+    finally:
+        settings.DEBUG = False
+        reset_queries()
+    return {'min': min(timings),
+            'mean': sum(timings) / len(timings),
+            'repeat': repeat,
+            'queries': queries}
+
+def check_response(response):
+    if response.status_code != 200:
+        raise AssertionError("Got status %d" % response.status_code)
+    # Consume streamed content, too
+    return response.content
+
+def run_scenario(version_count, page_size, repeat):
+    """Runs all benchmarks on a new page history."""
+    title = 'page-%d-%d' % (version_count, page_size)
+    old_text, new_text = make_history(title, version_count, page_size)
+
+    versions = Version.objects.filter(object_id=title).order_by('-id')
+    latest_id = versions.values_list('id', flat=True)[0]
+    client = Client()
+    path = '/%s' % title
+    last_page = max(1, (version_count + 19) // 20)
+
+    benchmarks = [
+        ('side_by_side_diff',
+         lambda: list(side_by_side_diff(old_text, new_text))),
+        ('context_diff',
+         lambda: list(context_diff(side_by_side_diff(old_text, new_text)))),
+        ('context_diff_tr',
+         lambda: DIFF_TEMPLATE.render(Context({'old_text': old_text,
+                                               'new_text': new_text}))),
+        ('view.edit',
+         lambda: check_response(client.get(path, {'action': 'edit'}))),
+        ('view.diff',
+         lambda: check_response(client.get(path,
+                                           {'action': 'diff',
+                                            'version_id': latest_id}))),
+        ('view.versions',
+         lambda: check_response(client.get(path, {'action': 'versions'}))),
+        ('view.versions.last_page',
+         lambda: check_response(client.get(path,
+                                           {'action': 'versions',
+                                            'page': last_page}))),
+    ]
+
+    results = []
+    for name, func in benchmarks:
+        result = measure(func, repeat)
+        result.update({'name': name,
+                       'versions': version_count,
+                       'page_size': page_size})
+        results.append(result)
+        sys.stderr.write("%-24s %7d versions %8d bytes: %9.2f ms\n"
+                         % (name, version_count, page_size,
+                            result['min'] * 1000))
+    return results
+
+def parse_scenario(option, opt, value, parser):
+    try:
+        version_count, page_size = [int(v) for v in value.split(':')]
+    except ValueError:
+        raise optparse.OptionValueError("Invalid scenario %r, use "
+                                        "VERSIONS:PAGE_SIZE" % value)
+    parser.values.scenarios = ((parser.values.scenarios or [])
+                               + [(version_count, page_size)])
+
+def main():
+    parser = optparse.OptionParser()
+    parser.add_option('--full', action='store_true', default=False,
+                      help="run all scenarios, up to 100k versions and 1 MB "
+                           "pages")
+    parser.add_option('--scenario', action='callback', type='string',
+                      callback=parse_scenario, dest='scenarios',
+                      help="run the given VERSIONS:PAGE_SIZE scenario, can "
+                           "be given several times")
+    parser.add_option('--repeat', type='int', default=5,
+                      help="number of runs per benchmark")
+    parser.add_option('--output', help="write JSON results to this file "
+                                       "instead of stdout")
+    options, _ = parser.parse_args()
+
+    scenarios = options.scenarios or (FULL_SCENARIOS if options.full
+                                      else DEFAULT_SCENARIOS)
+
+    setup_test_environment()
+    connection.creation.create_test_db(verbosity=0)
+
+    results = []
+    for version_count, page_size in scenarios:
+        results.extend(run_scenario(version_count, page_size, options.repeat))
+
+    report = {'date': datetime.datetime.utcnow().isoformat(),
+              'python': platform.python_version(),
+              'django': django.get_version(),
+              'results': results}
+    output = open(options.output, 'w') if options.output else sys.stdout
+    json.dump(report, output, indent=2, sort_keys=True)
+    output.write('\n')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,72 @@
+"""
+Micro-benchmark for turning a diff into side-by-side lines.
+
+The diff of a large text with many scattered changes is calculated once, then
+only the rendering step (escaping, splitting lines and wrapping changes in
+<ins></ins> and <del></del>) is timed.
+
+Run from the repository root:
+
+    $ PYTHONPATH=src python benchmarks/side_by_side_benchmark.py
+"""
+
+import optparse
+import random
+import time
+
+from wikify.diff_utils import side_by_side_diff, side_by_side_lines
+
+WORDS = "alpha beta gamma <delta> epsilon & zeta eta theta".split()
+
+def random_line(rnd, word_count):
+    return ' '.join(rnd.choice(WORDS) for _ in range(word_count))
+
+def make_texts(line_count, change_count, seed=0):
+    """Creates a text and a copy with changed, split and removed lines."""
+    rnd = random.Random(seed)
+    lines = [random_line(rnd, 12) for _ in range(line_count)]
+    changed_lines = list(lines)
+    for idx in rnd.sample(range(line_count), change_count):
+        kind = rnd.random()
+        if kind < 0.6:
+            words = changed_lines[idx].split()
+            words[rnd.randrange(len(words))] = rnd.choice(WORDS)
+            changed_lines[idx] = ' '.join(words)
+        elif kind < 0.8:
+            changed_lines[idx] += '\n' + random_line(rnd, 5)
+        else:
+            changed_lines[idx] = ''
+    return '\n'.join(lines), '\n'.join(changed_lines)
+
+def time_rendering(diff, repeat):
+    """Returns the best time for rendering the diff and the lines rendered."""
+    timings = []
+    for _ in range(repeat):
+        start = time.time()
+        line_count = sum(1 for _ in side_by_side_lines(diff))
+        timings.append(time.time() - start)
+    return min(timings), line_count
+
+def main():
+    parser = optparse.OptionParser()
+    parser.add_option('--lines', type='int', default=20000,
+                      help="number of lines in the text")
+    parser.add_option('--changes', type='int', default=2000,
+                      help="number of changed lines")
+    parser.add_option('--repeat', type='int', default=5,
+                      help="number of runs, the best one is reported")
+    options, _ = parser.parse_args()
+
+    old_text, new_text = make_texts(options.lines, options.changes)
+    # Without a time limit, so changes are refined within lines
+    result = side_by_side_diff(old_text, new_text, timeout=0)
+    if result.degraded:
+        raise AssertionError("Diff was degraded to whole lines")
+    diff = result.diff
+
+    best, line_count = time_rendering(diff, options.repeat)
+    print "%d diff entries, %d lines: %.1f ms (%d lines/s)" % (
+        len(diff), line_count, best * 1000, line_count / best)
+
+if __name__ == '__main__':
+    main()
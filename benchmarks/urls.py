@@ -0,0 +1,16 @@
+from django.conf.urls import patterns
+from django.http import HttpResponse
+
+from wikify import wikify
+
+from benchmarks.models import Page
+
+@wikify(Page)
+def page(request, object_id):
+    return HttpResponse("OK")
+
+urlpatterns = patterns("",
+
+    (r'^(?P<object_id>[^/]+)$', page),
+
+)
@@ -24,7 +24,10 @@ setup(name="django-wikify",
       author="Christoph Burgmer",
       author_email="cburgmer@ira.uka.de",
       url="http://github.com/cburgmer/django-wikify",
-      packages=["wikify"],
+      packages=["wikify",
+                "wikify.management",
+                "wikify.management.commands",
+                "wikify.templatetags"],
       package_dir={"": "src"},
       package_data = {"wikify": ["static/wikify/*.css", "templates/wikify/*.html"]},
       dependency_links = [
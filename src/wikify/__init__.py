@@ -1,29 +1,58 @@
 __all__ = ["wikify"]
 
+import threading
+
+def resolve_model(model_ref):
+    """Returns the model given either as class or as a dotted path string."""
+    if not isinstance(model_ref, basestring):
+        return model_ref
+
+    try:
+        module_str, model_str = model_ref.rsplit('.', 1)
+    except ValueError:
+        raise ValueError("Model reference %s needs to be of form "
+                         "'module.Model'" % model_ref)
+    try:
+        module = __import__(module_str, fromlist=[model_str])
+        return getattr(module, model_str)
+    except ImportError, e:
+        raise ValueError("Module %s not found: %s"
+                         % (module_str, e))
+    except AttributeError:
+        raise ValueError("Module %s has no attribute %s"
+                         % (module_str, model_str))
+
 def wikify(model_ref):
+    # Resolved on first request only, the model (and our views) might not be
+    #   importable yet when the decorator is applied
+    resolved = {}
+    lock = threading.Lock()
+
+    def resolve():
+        with lock:
+            if 'model' not in resolved:
+                # Import lazily, so we don't import views directly, saves us
+                # some trouble, e.g. https://bitbucket.org/kumar303/fudge/issue/17/module-import-order-influences-whether
+                from wikify.views import edit, diff, version, versions
+
+                model = resolve_model(model_ref)
+                resolved['primary_key'] = model._meta.pk.name
+                resolved['actions'] = {'edit': edit,
+                                       'diff': diff,
+                                       'version': version,
+                                       'versions': versions}
+                # Set last, marks the entries above as complete
+                resolved['model'] = model
+
     def decorator(func):
         def inner(request, *args, **kwargs):
-            # Import lazily, so we don't import views directly, saves us some
-            # trouble, e.g. https://bitbucket.org/kumar303/fudge/issue/17/module-import-order-influences-whether
-            from wikify.views import edit, diff, version, versions
-
-            if isinstance(model_ref, basestring):
-                try:
-                    module_str, model_str = model_ref.rsplit('.', 1)
-                    module = __import__(module_str, fromlist=[model_str])
-                    model = getattr(module, model_str)
-                except ImportError, e:
-                    raise ValueError("Module %s not found: %s"
-                                     % (module_str, e))
-                except AttributeError:
-                    raise ValueError("Module %s has no attribute %s"
-                                     % (module_str, model_str))
-            else:
-                model = model_ref
+            if 'model' not in resolved:
+                resolve()
+            model = resolved['model']
 
             # The primary key must be either given by the model field's name, or
             #   simply by Django's standard 'object_id'
-            primary_key = model._meta.pk.name
+            primary_key = resolved['primary_key']
             object_id = kwargs.get(primary_key) or kwargs.get('object_id')
 
             # Get action
@@ -32,14 +61,9 @@ def wikify(model_ref):
             else:
                 action = request.GET.get('action')
 
-            if action == 'edit':
-                return edit(request, model, object_id)
-            elif action == 'diff':
-                return diff(request, model, object_id)
-            elif action == 'version':
-                return version(request, model, object_id)
-            elif action == 'versions':
-                return versions(request, model, object_id)
+            view = resolved['actions'].get(action)
+            if view is not None:
+                return view(request, model, object_id)
             else:
                 # No valid action given, call decorated view
                 return func(request, *args, **kwargs)
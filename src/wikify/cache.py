@@ -0,0 +1,182 @@
+"""
+Caching of computed diffs.
+
+The difference between two stored versions never changes, so the context diff
+of a field can be kept in one of Django's caches. Set ``WIKIFY_DIFF_CACHE`` to
+the alias of a cache configured in ``CACHES`` to enable it. How many diffs are
+kept and which ones get evicted first is left to that backend, e.g. via the
+``MAX_ENTRIES`` option of the local memory and file based caches.
+``WIKIFY_DIFF_CACHE_MAX_SIZE`` limits the size (in characters) of a single
+cached diff, so that one huge diff does not push out many small ones.
+"""
+
+from django.conf import settings
+from django.contrib.contenttypes.models import ContentType
+from django.core.cache import get_cache
+from django.utils.encoding import force_unicode
+from reversion.models import Version
+
+from wikify.diff_utils import (context_diff, context_hunks, side_by_side_diff,
+                               DIFF_TIMEOUT)
+from wikify.executor import (calculate_context_diff, offloaded_context_diff,
+                             use_executor, TimeoutError)
+from wikify.utils import VersionFields, date_stamp
+
+# By old and new version id, date of the new version (only the latest version
+#   is replaced with one using the same id), field name and context lines
+DIFF_CACHE_KEY = 'wikify:diffops:%s:%s:%s:%s:%s'
+
+_caches = {}
+
+def get_diff_cache():
+    """Returns the cache configured for diffs, or None if caching is off."""
+    alias = getattr(settings, 'WIKIFY_DIFF_CACHE', None)
+    if not alias:
+        return None
+    if alias not in _caches:
+        _caches[alias] = get_cache(alias)
+    return _caches[alias]
+
+def reset_diff_caches():
+    """Drops the cache connections, e.g. in a newly forked process."""
+    _caches.clear()
+
+def diff_cache_key(old_version, new_version, field_name, context=2):
+    """Builds the cache key for the diff of a field between two versions."""
+    old_version_id = old_version.id if old_version else 0
+    return DIFF_CACHE_KEY % (old_version_id, new_version.id,
+                             date_stamp(new_version.revision.date_created),
+                             field_name, context)
+
+def cached_context_diff(old_text, new_text, context=2, key=None,
+                        timeout=None, max_size=None, offload=True,
+                        spans=False):
+    """
+    Returns the context diff between the two texts as an iterable of hunks, and
+    whether the diff was degraded to whole lines (see side_by_side_diff).
+    Lines are given as HTML, or as lists of spans if spans is True (see
+    context_hunks).
+
+    The time and size budget default to the WIKIFY_DIFF_TIMEOUT and
+    WIKIFY_DIFF_MAX_SIZE settings.
+
+    If a diff cache is configured and a key (see diff_cache_key) is given, the
+    diff is only calculated if it cannot be found in the cache. The cache holds
+    the compact form of the diff (see compact_context_diff), which is rendered
+    from the texts.
+
+    Large diffs are calculated in the pool configured by WIKIFY_DIFF_EXECUTOR
+    (see wikify.executor) unless offload is False. If the pool does not deliver
+    in time, the diff is degraded to whole lines. Degraded diffs are never
+    cached.
+
+    Without a cache and pool, HTML hunks are built lazily while they are
+    iterated over, so streamed pages get their first rows early.
+    """
+    cache = get_diff_cache() if key else None
+    compact_diff = cache.get(key) if cache is not None else None
+
+    if compact_diff is None:
+        if timeout is None:
+            timeout = getattr(settings, 'WIKIFY_DIFF_TIMEOUT', DIFF_TIMEOUT)
+        if max_size is None:
+            max_size = getattr(settings, 'WIKIFY_DIFF_MAX_SIZE', None)
+
+        offload = offload and use_executor(old_text, new_text)
+        if cache is None and not offload and not spans:
+            # Nothing to store, skip the compact form
+            diff = side_by_side_diff(old_text, new_text, timeout=timeout,
+                                     max_size=max_size)
+            return context_diff(diff, context=context), diff.degraded
+
+        store = cache is not None
+        if offload:
+            try:
+                compact_diff = offloaded_context_diff(old_text, new_text,
+                                                      context, timeout,
+                                                      max_size)
+            except TimeoutError:
+                # Show whole lines for now, but don't cache that, the pool
+                #   might just be busy. Even lines take long for giant texts,
+                #   keep to the budget
+                compact_diff = calculate_context_diff(old_text, new_text,
+                                                      context, timeout,
+                                                      max_size=0)
+                compact_diff = compact_diff[:2] + (True, )
+                store = False
+        else:
+            compact_diff = calculate_context_diff(old_text, new_text, context,
+                                                  timeout, max_size)
+            # A diff degraded to whole lines is not kept for good, next time
+            #   there might be enough time
+            if compact_diff[2]:
+                store = False
+
+        if store:
+            opcodes = compact_diff[0]
+            max_cache_size = getattr(settings, 'WIKIFY_DIFF_CACHE_MAX_SIZE',
+                                     None)
+            if max_cache_size is None or opcodes.size() <= max_cache_size:
+                cache.set(key, compact_diff,
+                          getattr(settings, 'WIKIFY_DIFF_CACHE_TIMEOUT', None))
+
+    opcodes, ranges, degraded = compact_diff
+    return (context_hunks(opcodes, ranges, old_text, new_text, spans=spans),
+            degraded)
+
+def version_pairs(versions):
+    """
+    Yields each version together with the one before it of the same object,
+    as (content_type_id, old_version_id, new_version_id, date_created). The
+    old version id is None for the first version of an object.
+
+    Versions are given as (id, content_type_id, object_id, date_created) and
+    need to be ordered by content type, object and id.
+    """
+    previous = None
+    for version_id, content_type_id, object_id, date_created in versions:
+        if previous != (content_type_id, object_id):
+            old_version_id = None
+        yield content_type_id, old_version_id, version_id, date_created
+        previous = (content_type_id, object_id)
+        old_version_id = version_id
+
+def warm_diff_cache(pairs, force=False):
+    """
+    Calculates the diffs of the changed fields between the given versions
+    (see version_pairs) and stores them in the diff cache. Diffs already
+    cached are skipped unless force is given.
+
+    Returns the number of diffs calculated. Diffs are calculated in the
+    calling process, which is expected to run in the background already.
+    """
+    cache = get_diff_cache()
+    if cache is None:
+        return 0
+
+    version_ids = set()
+    for _, old_version_id, new_version_id in pairs:
+        version_ids.update((old_version_id, new_version_id))
+    version_ids.discard(None)
+    versions = Version.objects.select_related('revision').in_bulk(
+                                                            list(version_ids))
+
+    count = 0
+    for content_type_id, old_version_id, new_version_id in pairs:
+        model = ContentType.objects.get_for_id(content_type_id).model_class()
+        new_version = versions.get(new_version_id)
+        if model is None or new_version is None:
+            continue
+        old_version = versions.get(old_version_id)
+        fields = VersionFields(model, old_version, new_version).changed()
+        for field, old_value, new_value in fields:
+            key = diff_cache_key(old_version, new_version, field.name)
+            if force:
+                cache.delete(key)
+            elif cache.get(key) is not None:
+                continue
+            cached_context_diff(force_unicode(old_value) if old_value else '',
+                                force_unicode(new_value) if new_value else '',
+                                key=key, offload=False)
+            count += 1
+    return count
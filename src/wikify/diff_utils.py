@@ -1,111 +1,533 @@
-__all__ = ["side_by_side_diff", "context_diff"]
+__all__ = ["side_by_side_diff", "context_diff", "context_ranges", "context_hunks"]
 
-import itertools
-import re
+from array import array
+from itertools import islice, izip_longest
+import time
 
 import diff_match_patch
 
 
-line_split = re.compile(r'(?:\r?\n)')
+# Texts longer than this (in characters) are diffed line by line first
+LINE_MODE_THRESHOLD = 10000
 
-def side_by_side_diff(old_text, new_text):
+# Default time budget for calculating a diff in seconds, same as
+#   diff_match_patch's own default
+DIFF_TIMEOUT = 1.0
+
+def line_diff(dmp, old_text, new_text):
     """
-    Calculates a side-by-side line-based difference view.
+    Calculates the difference between both texts on whole lines.
 
-    Wraps insertions in <ins></ins> and deletions in <del></del>.
+    Each line is mapped to a single character first (see
+    diff_match_patch.diff_linesToChars), so unchanged lines are cheap to skip.
+    """
+    # Common lines at the start and end need no hashing
+    prefix_len = dmp.diff_commonPrefix(old_text, new_text)
+    prefix_len = old_text.rfind('\n', 0, prefix_len) + 1
+    old_middle, new_middle = old_text[prefix_len:], new_text[prefix_len:]
+
+    suffix_len = dmp.diff_commonSuffix(old_middle, new_middle)
+    old_start = len(old_middle) - suffix_len
+    new_start = len(new_middle) - suffix_len
+    if ((old_start and old_middle[old_start - 1] != '\n')
+        or (new_start and new_middle[new_start - 1] != '\n')):
+        # Only keep the suffix starting from the next full line
+        newline = old_middle.find('\n', old_start)
+        suffix_len = len(old_middle) - newline - 1 if newline != -1 else 0
+    suffix = old_middle[len(old_middle) - suffix_len:] if suffix_len else ''
+    if suffix_len:
+        old_middle = old_middle[:-suffix_len]
+        new_middle = new_middle[:-suffix_len]
+
+    old_chars, new_chars, line_array = dmp.diff_linesToChars(old_middle,
+                                                             new_middle)
+    diff = dmp.diff_main(old_chars, new_chars, False)
+    dmp.diff_charsToLines(diff, line_array)
+
+    if prefix_len:
+        diff.insert(0, (0, old_text[:prefix_len]))
+    if suffix:
+        diff.append((0, suffix))
+    return diff
+
+def count_lines(text):
+    """Returns the number of lines in the text, the last one may be open."""
+    if not text:
+        return 0
+    return text.count('\n') + (not text.endswith('\n'))
+
+def line_change_counts(old_text, new_text):
+    """Returns the number of lines added and removed from old to new text."""
+    # A missing newline at the end does not make the last line a changed one
+    if old_text and not old_text.endswith('\n'):
+        old_text += '\n'
+    if new_text and not new_text.endswith('\n'):
+        new_text += '\n'
+
+    added = removed = 0
+    dmp = diff_match_patch.diff_match_patch()
+    for op, text in line_diff(dmp, old_text, new_text):
+        if op == dmp.DIFF_INSERT:
+            added += count_lines(text)
+        elif op == dmp.DIFF_DELETE:
+            removed += count_lines(text)
+    return added, removed
+
+def refined_line_diff(dmp, old_text, new_text, deadline=None):
     """
-    def yield_open_change_site(open_change_site):
-        """ Yield all open changes. """
-        ls, rs = open_change_site
-        # Get unchanged parts onto the right line
-        if ls[0] == rs[0]:
-            yield (ls[0], rs[0])
-            for l, r in itertools.izip_longest(ls[1:], rs[1:]):
-                yield (l, r)
-        elif ls[-1] == rs[-1]:
-            for l, r in itertools.izip_longest(ls[:-1], rs[:-1]):
-                yield (l, r)
-            yield (ls[-1], rs[-1])
+    Calculates a character-based difference, running the character diff only
+    on lines changed according to a line diff.
+
+    Changes left once the deadline has passed are only diffed by whole lines.
+    Returns the diff and whether it had to be degraded that way.
+    """
+    diff = []
+    degraded = False
+    deleted, inserted = [], []
+    for change_type, entry in line_diff(dmp, old_text, new_text) + [(0, '')]:
+        if change_type == -1:
+            deleted.append(entry)
+        elif change_type == 1:
+            inserted.append(entry)
         else:
-            for l, r in itertools.izip_longest(ls, rs):
-                yield (l, r)
+            if deleted or inserted:
+                deleted, inserted = ''.join(deleted), ''.join(inserted)
+                if deadline is not None:
+                    dmp.Diff_Timeout = deadline - time.time()
+                    if dmp.Diff_Timeout <= 0:
+                        degraded = True
+                if degraded:
+                    hunk = [(-1, deleted), (1, inserted)]
+                else:
+                    hunk = dmp.diff_main(deleted, inserted)
+                    dmp.diff_cleanupSemantic(hunk)
+                diff.extend(hunk)
+                deleted, inserted = [], []
+            if entry:
+                diff.append((change_type, entry))
+    if deadline is not None and time.time() > deadline:
+        degraded = True
+    return diff, degraded
+
+class SideBySideDiff(object):
+    """
+    The result of side_by_side_diff, iterates over pairs of old and new lines.
+
+    The diff is marked as degraded if it ran out of its budget and changes are
+    (partly) only shown by whole lines.
+    """
+    def __init__(self, diff, degraded=False):
+        self.diff = diff
+        self.degraded = degraded
+
+    def __iter__(self):
+        return side_by_side_lines(self.diff)
+
+    def opcodes(self):
+        """Returns the pairs of old and new lines as LineOpcodes."""
+        return side_by_side_opcodes(self.diff)
+
+def side_by_side_diff(old_text, new_text, line_mode=None, timeout=DIFF_TIMEOUT,
+                      max_size=None):
+    """
+    Calculates a side-by-side line-based difference view.
+
+    Wraps insertions in <ins></ins> and deletions in <del></del>.
 
+    In line mode unchanged lines are skipped before the character diff is
+    calculated, which is a lot faster for big texts with scattered changes. By
+    default line mode is used for texts longer than LINE_MODE_THRESHOLD.
+
+    The calculation is limited to timeout seconds (0 means no limit), and
+    texts longer than max_size characters in total are only diffed by whole
+    lines. If either budget is exceeded the result is marked as degraded.
+    """
     # Treat an empty string and "None" as same
     old_text = old_text or ''
     new_text = new_text or ''
     if not old_text and not new_text:
-        return
+        return SideBySideDiff([])
 
     dmp = diff_match_patch.diff_match_patch()
+    dmp.Diff_Timeout = timeout or 0
+    deadline = time.time() + timeout if timeout else None
+
+    if max_size is not None and len(old_text) + len(new_text) > max_size:
+        return SideBySideDiff(line_diff(dmp, old_text, new_text),
+                              degraded=True)
+
+    if line_mode is None:
+        line_mode = len(old_text) + len(new_text) > LINE_MODE_THRESHOLD
+    if line_mode:
+        diff, degraded = refined_line_diff(dmp, old_text, new_text, deadline)
+    else:
+        diff = dmp.diff_main(old_text, new_text)
+        dmp.diff_cleanupSemantic(diff)
+        degraded = deadline is not None and time.time() > deadline
+        if degraded:
+            # The character diff stopped early and is coarse, whole lines
+            #   read better
+            dmp.Diff_Timeout = timeout
+            diff = line_diff(dmp, old_text, new_text)
+
+    return SideBySideDiff(diff, degraded)
+
+def escape_html(text):
+    """Quotes the characters with a special meaning in HTML."""
+    # Chained replace runs in C and beats both a translation table and a
+    #   regular expression substitution
+    return text.replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;')
+
+def split_lines(text):
+    """Splits text on Unix and Windows line breaks."""
+    lines = text.split('\n')
+    if '\r' in text:
+        lines = [line[:-1] if line.endswith('\r') else line
+                 for line in lines[:-1]] + lines[-1:]
+    return lines
+
+def open_change_site_lines(ls, rs):
+    """
+    Pairs up the old and new lines around one change site, keeping unchanged
+    parts on the same line.
+    """
+    if len(ls) == 1 and len(rs) == 1:
+        # The common case of a single (changed) line
+        yield (ls[0], rs[0])
+    # Get unchanged parts onto the right line
+    elif ls[0] == rs[0]:
+        yield (ls[0], rs[0])
+        for entry in izip_longest(islice(ls, 1, None),
+                                  islice(rs, 1, None)):
+            yield entry
+    elif ls[-1] == rs[-1]:
+        for entry in izip_longest(islice(ls, len(ls) - 1),
+                                  islice(rs, len(rs) - 1)):
+            yield entry
+        yield (ls[-1], rs[-1])
+    else:
+        for entry in izip_longest(ls, rs):
+            yield entry
+
+def side_by_side_lines(diff):
+    """
+    Turns a diff_match_patch diff into pairs of old and new lines, see
+    side_by_side_diff.
+    """
+    yield_open_change_site = open_change_site_lines
 
-    diff = dmp.diff_main(old_text, new_text)
-    dmp.diff_cleanupSemantic(diff)
+    if not diff:
+        return
 
     # Store multiple changes around one change site. Insertions & deletions can
     #   result in lines in the old_text corresponding to two and more lines in
     #   the new_text. We want to commit them in a batch together.
-    open_change_site = ([None], [None])
+    ls, rs = [None], [None]
 
     for change_type, entry in diff:
         assert change_type in [-1, 0, 1]
 
         # Quote XML as we are inserting our own
-        entry = (entry.replace('&', '&amp;')
-                      .replace('<', '&lt;')
-                      .replace('>', '&gt;'))
-
-        lines = line_split.split(entry)
-
-        ls, rs = open_change_site
+        lines = split_lines(escape_html(entry))
 
         # Merge with previous entry, an unfinished line, (if still open)
         first_line = lines[0]
         if change_type == 0:
-            ls[-1] = ls[-1] or ''
-            rs[-1] = rs[-1] or ''
-            ls[-1] = ls[-1] + first_line
-            rs[-1] = rs[-1] + first_line
+            ls[-1] = (ls[-1] or '') + first_line
+            rs[-1] = (rs[-1] or '') + first_line
         elif change_type == 1:
-            rs[-1] = rs[-1] or ''
-            rs[-1] += '<ins>%s</ins>' % first_line if first_line else ''
-        elif change_type == -1:
-            ls[-1] = ls[-1] or ''
-            ls[-1] += '<del>%s</del>' % first_line if first_line else ''
-
-        lines = lines[1:]
+            rs[-1] = (rs[-1] or '') + ('<ins>%s</ins>' % first_line
+                                       if first_line else '')
+        else:
+            ls[-1] = (ls[-1] or '') + ('<del>%s</del>' % first_line
+                                       if first_line else '')
 
-        if lines:
+        if len(lines) > 1:
             if change_type == 0:
                 # Push out open change site as we now have a 1:1 mapping of an
                 #   old and new line
-                for entry in yield_open_change_site(open_change_site):
+                for entry in yield_open_change_site(ls, rs):
                     yield entry
 
                 # Directly push out lines until last
-                for line in lines[:-1]:
+                for line in islice(lines, 1, len(lines) - 1):
                     yield (line, line)
 
                 # Keep last line open
-                open_change_site = ([lines[-1]], [lines[-1]])
+                ls, rs = [lines[-1]], [lines[-1]]
             elif change_type == 1:
-                ls, rs = open_change_site
+                rs.extend(['<ins>%s</ins>' % line if line else ''
+                           for line in islice(lines, 1, None)])
+            else:
+                ls.extend(['<del>%s</del>' % line if line else ''
+                           for line in islice(lines, 1, None)])
 
-                for line in lines:
-                    rs.append('<ins>%s</ins>' % line if line else '')
+    # Push out open entry
+    for entry in yield_open_change_site(ls, rs):
+        yield entry
 
-                open_change_site = (ls, rs)
-            elif change_type == -1:
-                ls, rs = open_change_site
+class LineKey(object):
+    """
+    Wraps a line given as spans (change type, start, end, text) so that lines
+    compare like their HTML would, see side_by_side_opcodes.
+    """
+    __slots__ = ('spans', '_key')
+
+    def __init__(self, spans):
+        self.spans = spans
+        self._key = None
+
+    @property
+    def key(self):
+        if self._key is None:
+            # Adjacent spans of the same type render as one
+            key = []
+            for change_type, _, _, text in self.spans:
+                if key and key[-1][0] == change_type:
+                    key[-1] = (change_type, key[-1][1] + text)
+                else:
+                    key.append((change_type, text))
+            self._key = key
+        return self._key
+
+    def __eq__(self, other):
+        return other is not None and self.key == other.key
+
+    def __ne__(self, other):
+        return not self == other
+
+class LineOpcodes(object):
+    """
+    Pairs of old and new lines like given by side_by_side_lines, held as
+    offsets into the old and new text instead of as HTML.
+
+    For each line pair the changed array tells whether the lines differ. The
+    bounds array holds four entries per line pair, the first and (one past the)
+    last index into spans of the old line and of the new line, or -1 for a
+    missing line. The spans array holds three entries per span: the change type
+    (0 unchanged, -1 deleted, 1 inserted), and start and end offset of the text
+    in the old (unchanged and deleted) or new text (unchanged and inserted).
+
+    Only the texts are needed to render the lines, see html_lines() and
+    span_lines(), so the diff itself is small to store and quick to compare.
+    """
+    def __init__(self):
+        self.changed = array('b')
+        self.bounds = array('i')
+        self.spans = array('i')
+
+    def __len__(self):
+        return len(self.changed)
+
+    def __getstate__(self):
+        return (self.changed, self.bounds, self.spans)
+
+    def __setstate__(self, state):
+        self.changed, self.bounds, self.spans = state
+
+    def append(self, left, right):
+        """Adds a line pair, each line a LineKey or None."""
+        self.changed.append(left is None or right is None or left != right)
+        for line in (left, right):
+            if line is None:
+                self.bounds.extend((-1, -1))
+                continue
+            first = len(self.spans) // 3
+            for change_type, start, end, _ in line.spans:
+                self.spans.extend((change_type, start, end))
+            self.bounds.extend((first, first + len(line.spans)))
+
+    def line_spans(self, idx):
+        """
+        Returns the spans of the old and new line of the line pair as lists of
+        (change type, start, end), None for a missing line.
+        """
+        bounds, spans = self.bounds, self.spans
+        lines = []
+        for first, stop in (bounds[4 * idx:4 * idx + 2],
+                            bounds[4 * idx + 2:4 * idx + 4]):
+            if first == -1:
+                lines.append(None)
+            else:
+                lines.append([tuple(spans[3 * span:3 * span + 3])
+                              for span in range(first, stop)])
+        return lines
+
+    def html_lines(self, old_text, new_text, start=0, stop=None):
+        """
+        Yields the old and new lines from start to stop as HTML, wrapping
+        insertions in <ins></ins> and deletions in <del></del>.
+        """
+        if stop is None:
+            stop = len(self)
+        for idx in range(start, stop):
+            lines = []
+            for line, text in zip(self.line_spans(idx), (old_text, new_text)):
+                if line is None:
+                    lines.append(None)
+                    continue
+                parts = []
+                for change_type, span_start, span_end in line:
+                    part = escape_html(text[span_start:span_end])
+                    if change_type == 1:
+                        part = '<ins>%s</ins>' % part
+                    elif change_type == -1:
+                        part = '<del>%s</del>' % part
+                    parts.append(part)
+                lines.append(''.join(parts))
+            yield tuple(lines)
+
+    def span_lines(self, old_text, new_text, start=0, stop=None):
+        """
+        Yields the old and new lines from start to stop as lists of (change
+        type, text) spans, None for a missing line.
+        """
+        if stop is None:
+            stop = len(self)
+        for idx in range(start, stop):
+            yield tuple(None if line is None
+                        else [(change_type, text[span_start:span_end])
+                              for change_type, span_start, span_end in line]
+                        for line, text in zip(self.line_spans(idx),
+                                              (old_text, new_text)))
+
+    def extract(self, ranges):
+        """
+        Returns a LineOpcodes of only the line pairs in the given context
+        ranges (see context_ranges), together with the ranges adjusted to it.
+        """
+        opcodes = LineOpcodes()
+        extracted_ranges = []
+        for left_line_idx, right_line_idx, start, stop in ranges:
+            extracted_ranges.append((left_line_idx, right_line_idx,
+                                     len(opcodes), len(opcodes) + stop - start))
+            for idx in range(start, stop):
+                for first, last in (self.bounds[4 * idx:4 * idx + 2],
+                                    self.bounds[4 * idx + 2:4 * idx + 4]):
+                    if first == -1:
+                        opcodes.bounds.extend((-1, -1))
+                    else:
+                        offset = len(opcodes.spans) // 3
+                        opcodes.bounds.extend((offset, offset + last - first))
+                        opcodes.spans.extend(self.spans[3 * first:3 * last])
+            opcodes.changed.extend(self.changed[start:stop])
+        return opcodes, extracted_ranges
+
+    def size(self, start=0, stop=None):
+        """Returns the number of characters of the lines from start to stop."""
+        if stop is None:
+            stop = len(self)
+        bounds, spans = self.bounds, self.spans
+        size = 0
+        for idx in range(start, stop):
+            for first, last in (bounds[4 * idx:4 * idx + 2],
+                                bounds[4 * idx + 2:4 * idx + 4]):
+                for span in range(max(first, 0), last):
+                    size += spans[3 * span + 2] - spans[3 * span + 1]
+        return size
+
+def split_line_offsets(text, offset):
+    """
+    Splits text like split_lines, returning each line as (start, end, line)
+    with offsets counted from the given offset.
+    """
+    pieces = []
+    append = pieces.append
+    for line in text.split('\n'):
+        end = offset + len(line)
+        append((offset, end, line))
+        offset = end + 1
+    if '\r' in text:
+        pieces[:-1] = [(start, end - 1, line[:-1]) if line.endswith('\r')
+                       else (start, end, line)
+                       for start, end, line in pieces[:-1]]
+    return pieces
+
+def side_by_side_opcodes(diff):
+    """
+    Turns a diff_match_patch diff into a LineOpcodes holding the same pairs of
+    old and new lines as side_by_side_lines.
+    """
+    opcodes = LineOpcodes()
+    if not diff:
+        return opcodes
+    changed, bounds, spans = opcodes.changed, opcodes.bounds, opcodes.spans
 
-                for line in lines:
-                    ls.append('<del>%s</del>' % line if line else '')
+    # Lines are collected as lists of (change type, start, end, text) spans,
+    #   the texts are only used to compare lines and dropped afterwards
+    ls, rs = [None], [None]
+    old_pos = new_pos = 0
 
-                open_change_site = (ls, rs)
+    for change_type, entry in diff:
+        assert change_type in [-1, 0, 1]
 
-    # Push out open entry
-    for entry in yield_open_change_site(open_change_site):
-        yield entry
+        if change_type == 1:
+            pieces = split_line_offsets(entry, new_pos)
+            new_pos += len(entry)
+        else:
+            pieces = split_line_offsets(entry, old_pos)
+            # Unchanged text has the same lines in the new text, just shifted
+            shift = new_pos - old_pos
+            old_pos += len(entry)
+            if change_type == 0:
+                new_pos += len(entry)
+
+        # Merge with previous entry, an unfinished line, (if still open)
+        start, end, first_line = pieces[0]
+        if change_type == 0:
+            if first_line:
+                ls[-1] = LineKey((ls[-1].spans if ls[-1] else [])
+                                 + [(0, start, end, first_line)])
+                rs[-1] = LineKey((rs[-1].spans if rs[-1] else [])
+                                 + [(0, start + shift, end + shift,
+                                     first_line)])
+            else:
+                ls[-1] = ls[-1] or LineKey([])
+                rs[-1] = rs[-1] or LineKey([])
+        elif change_type == 1:
+            rs[-1] = LineKey((rs[-1].spans if rs[-1] else [])
+                             + ([(1, start, end, first_line)]
+                                if first_line else []))
+        else:
+            ls[-1] = LineKey((ls[-1].spans if ls[-1] else [])
+                             + ([(-1, start, end, first_line)]
+                                if first_line else []))
 
+        if len(pieces) > 1:
+            if change_type == 0:
+                for left, right in open_change_site_lines(ls, rs):
+                    opcodes.append(left, right)
+
+                # Directly add the unchanged lines until last
+                span_count = len(spans) // 3
+                for start, end, line in islice(pieces, 1, len(pieces) - 1):
+                    changed.append(0)
+                    if line:
+                        spans.extend((0, start, end,
+                                      0, start + shift, end + shift))
+                        bounds.extend((span_count, span_count + 1,
+                                       span_count + 1, span_count + 2))
+                        span_count += 2
+                    else:
+                        bounds.extend((span_count, span_count,
+                                       span_count, span_count))
+
+                start, end, line = pieces[-1]
+                if line:
+                    ls = [LineKey([(0, start, end, line)])]
+                    rs = [LineKey([(0, start + shift, end + shift, line)])]
+                else:
+                    ls, rs = [LineKey([])], [LineKey([])]
+            elif change_type == 1:
+                rs.extend([LineKey([(1, start, end, line)] if line else [])
+                           for start, end, line in islice(pieces, 1, None)])
+            else:
+                ls.extend([LineKey([(-1, start, end, line)] if line else [])
+                           for start, end, line in islice(pieces, 1, None)])
+
+    for left, right in open_change_site_lines(ls, rs):
+        opcodes.append(left, right)
+    return opcodes
 
 def context_diff(diff, context=2):
     if context < 0:
@@ -165,3 +587,47 @@ def context_diff(diff, context=2):
         yield (current_change_left_line_idx,
                 current_change_right_line_idx,
                 current_change_context)
+
+def context_ranges(opcodes, context=2):
+    """
+    Like context_diff, but for the line pairs of a LineOpcodes. Yields for
+    each change the indices of its first old and new line and the range of
+    line pairs shown, as (left_line_idx, right_line_idx, start, stop).
+    """
+    def line_keys():
+        # Small integers that compare like the lines do, only changed lines
+        #   differ
+        bounds = opcodes.bounds
+        for idx, changed in enumerate(opcodes.changed):
+            left = None if bounds[4 * idx] == -1 else (~idx if changed else idx)
+            right = None if bounds[4 * idx + 2] == -1 else idx
+            yield left, right
+
+    def line_idx(entry):
+        left, right = entry
+        return right if right is not None else ~left
+
+    for left_line_idx, right_line_idx, lines in context_diff(line_keys(),
+                                                             context):
+        yield (left_line_idx, right_line_idx,
+               line_idx(lines[0]), line_idx(lines[-1]) + 1)
+
+def compact_context_diff(diff, context=2):
+    """
+    Returns the context diff of a SideBySideDiff in compact form, as the
+    LineOpcodes of the lines shown and their context ranges. See
+    context_hunks for rendering it.
+    """
+    opcodes = diff.opcodes()
+    return opcodes.extract(context_ranges(opcodes, context))
+
+def context_hunks(opcodes, ranges, old_text, new_text, spans=False):
+    """
+    Renders the context ranges of the diff into hunks like given by
+    context_diff, with lines as HTML or, if spans is True, as (change type,
+    text) spans (see LineOpcodes).
+    """
+    render = opcodes.span_lines if spans else opcodes.html_lines
+    for left_line_idx, right_line_idx, start, stop in ranges:
+        yield (left_line_idx, right_line_idx,
+               list(render(old_text, new_text, start, stop)))
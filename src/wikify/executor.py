@@ -0,0 +1,85 @@
+"""
+Calculation of large diffs in a pool of threads or processes.
+
+A diff of a giant page can keep the process serving the request busy for a
+long time, which hurts all requests queued up behind it. Set
+``WIKIFY_DIFF_EXECUTOR`` to ``'thread'`` or ``'process'`` to calculate diffs of
+texts longer than ``WIKIFY_DIFF_EXECUTOR_THRESHOLD`` characters in a pool of
+``WIKIFY_DIFF_EXECUTOR_SIZE`` workers instead. Requests wait at most
+``WIKIFY_DIFF_EXECUTOR_TIMEOUT`` seconds for the result (including the time
+spent waiting for a free worker) and raise TimeoutError otherwise.
+
+Thread pools only help where the diff library releases the interpreter lock,
+which the pure Python diff_match_patch does not, so a process pool is usually
+the better choice.
+"""
+
+import threading
+from multiprocessing import Pool, TimeoutError
+from multiprocessing.pool import ThreadPool
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+
+from wikify.diff_utils import side_by_side_diff, compact_context_diff
+
+EXECUTOR_THRESHOLD = 100000
+
+EXECUTOR_SIZE = 2
+
+EXECUTOR_TIMEOUT = 10.0
+
+POOL_CLASSES = {'thread': ThreadPool,
+                'process': Pool}
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+def calculate_context_diff(old_text, new_text, context=2, timeout=None,
+                           max_size=None):
+    """
+    Returns the context diff between the two texts in compact form (see
+    compact_context_diff) as (opcodes, ranges, degraded). Also runs inside the
+    pool, so arguments and result need to be picklable.
+    """
+    diff = side_by_side_diff(old_text, new_text, timeout=timeout,
+                             max_size=max_size)
+    opcodes, ranges = compact_context_diff(diff, context=context)
+    return opcodes, ranges, diff.degraded
+
+def get_pool():
+    """Returns the configured pool, or None if diffs are run inline."""
+    kind = getattr(settings, 'WIKIFY_DIFF_EXECUTOR', None)
+    if not kind:
+        return None
+    if kind not in POOL_CLASSES:
+        raise ImproperlyConfigured("WIKIFY_DIFF_EXECUTOR needs to be one of "
+                                   "%s, not %r"
+                                   % (', '.join(sorted(POOL_CLASSES)), kind))
+    size = getattr(settings, 'WIKIFY_DIFF_EXECUTOR_SIZE', EXECUTOR_SIZE)
+    with _pools_lock:
+        if (kind, size) not in _pools:
+            _pools[(kind, size)] = POOL_CLASSES[kind](size)
+        return _pools[(kind, size)]
+
+def use_executor(old_text, new_text):
+    """Returns whether the diff of the two texts should run in the pool."""
+    if not getattr(settings, 'WIKIFY_DIFF_EXECUTOR', None):
+        return False
+    threshold = getattr(settings, 'WIKIFY_DIFF_EXECUTOR_THRESHOLD',
+                        EXECUTOR_THRESHOLD)
+    return len(old_text) + len(new_text) > threshold
+
+def offloaded_context_diff(old_text, new_text, context=2, timeout=None,
+                           max_size=None):
+    """
+    Calculates the context diff in the pool, see calculate_context_diff.
+
+    Raises TimeoutError if the result is not ready in time. The calculation
+    itself keeps going, but is bounded by the diff's own time budget.
+    """
+    result = get_pool().apply_async(calculate_context_diff,
+                                    (old_text, new_text, context, timeout,
+                                     max_size))
+    return result.get(getattr(settings, 'WIKIFY_DIFF_EXECUTOR_TIMEOUT',
+                              EXECUTOR_TIMEOUT))
@@ -0,0 +1,55 @@
+from optparse import make_option
+
+from django.contrib.contenttypes.models import ContentType
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from reversion import models
+
+from wikify import resolve_model
+from wikify.models import VersionStats
+from wikify.stats import iter_missing_version_stats
+
+class Command(BaseCommand):
+    args = '[module.Model ...]'
+    help = ("Stores the change stats of all versions that have none yet, "
+            "optionally only for the given models.")
+    option_list = BaseCommand.option_list + (
+        make_option('--batch-size', type='int', default=500,
+                    help="Number of stats saved at once (default: 500)."),
+    )
+
+    def handle(self, *model_refs, **options):
+        batch_size = options['batch_size']
+        if batch_size < 1:
+            raise CommandError("Batch size needs to be positive")
+
+        versions = models.Version.objects.all()
+        if model_refs:
+            try:
+                content_types = [ContentType.objects.get_for_model(
+                                                      resolve_model(model_ref))
+                                 for model_ref in model_refs]
+            except ValueError, e:
+                raise CommandError(str(e))
+            versions = versions.filter(content_type__in=content_types)
+        versions = versions.order_by('content_type', 'object_id', 'id')
+
+        existing_ids = set(VersionStats.objects.values_list('version_id',
+                                                            flat=True))
+        count = 0
+        batch = []
+        for stats in iter_missing_version_stats(versions.iterator(),
+                                                existing_ids):
+            batch.append(stats)
+            if len(batch) == batch_size:
+                count += self.save_batch(batch)
+                batch = []
+        if batch:
+            count += self.save_batch(batch)
+
+        self.stdout.write("Stored stats for %d versions\n" % count)
+
+    @transaction.commit_on_success
+    def save_batch(self, batch):
+        VersionStats.objects.bulk_create(batch)
+        return len(batch)
@@ -0,0 +1,67 @@
+from optparse import make_option
+
+from django.contrib.contenttypes.models import ContentType
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+import reversion
+from reversion import models
+
+from wikify import resolve_model
+from wikify.storage import data_size, format_size, get_compression, recompress
+
+class Command(BaseCommand):
+    args = '[module.Model ...]'
+    help = ("Stores the data of all versions of registered models, optionally "
+            "only of the given ones, compressed as configured by "
+            "WIKIFY_COMPRESSION and WIKIFY_COMPRESSION_LEVEL, or uncompressed "
+            "if WIKIFY_COMPRESSION is not set.")
+    option_list = BaseCommand.option_list + (
+        make_option('--batch-size', type='int', default=500,
+                    help="Number of versions loaded and saved at once "
+                         "(default: 500)."),
+    )
+
+    def handle(self, *model_refs, **options):
+        batch_size = options['batch_size']
+        if batch_size < 1:
+            raise CommandError("Batch size needs to be positive")
+        method, _ = get_compression()
+
+        try:
+            model_list = ([resolve_model(model_ref) for model_ref in model_refs]
+                          or reversion.get_registered_models())
+        except ValueError, e:
+            raise CommandError(str(e))
+        content_types = [ContentType.objects.get_for_model(model)
+                         for model in model_list]
+
+        versions = models.Version.objects.filter(content_type__in=content_types)
+        version_ids = list(versions.order_by('id')
+                                   .values_list('id', flat=True))
+
+        count = changed_count = size_before = size_after = 0
+        for idx in range(0, len(version_ids), batch_size):
+            batch = (versions.filter(id__in=version_ids[idx:idx + batch_size])
+                             .values_list('id', 'serialized_data'))
+            changed = []
+            for version_id, data in batch:
+                new_data = recompress(data)
+                if new_data != data:
+                    changed.append((version_id, new_data))
+                size_before += data_size(data)
+                size_after += data_size(new_data)
+                count += 1
+            changed_count += self.save_batch(changed)
+
+        self.stdout.write("%s %d of %d versions, %s to %s (ratio %.1f)\n"
+                          % ("Compressed" if method else "Decompressed",
+                             changed_count, count, format_size(size_before),
+                             format_size(size_after),
+                             float(size_before) / max(size_after, 1)))
+
+    @transaction.commit_on_success
+    def save_batch(self, changed):
+        for version_id, data in changed:
+            models.Version.objects.filter(id=version_id).update(
+                                                          serialized_data=data)
+        return len(changed)
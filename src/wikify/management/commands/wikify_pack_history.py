@@ -0,0 +1,82 @@
+from optparse import make_option
+
+from django.contrib.contenttypes.models import ContentType
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+import reversion
+from reversion import models
+
+from wikify import resolve_model
+from wikify.storage import (compress_version, data_size, format_size,
+                            pack_version, unpack_version)
+
+class Command(BaseCommand):
+    args = '[module.Model ...]'
+    help = ("Stores the versions of registered models, optionally only of the "
+            "given ones, as deltas to their previous version (see "
+            "WIKIFY_DELTA_STORAGE), and reports the saved space.")
+    option_list = BaseCommand.option_list + (
+        make_option('--unpack', action='store_true', default=False,
+                    help="Store full copies of all versions again, e.g. "
+                         "before disabling WIKIFY_DELTA_STORAGE."),
+        make_option('--batch-size', type='int', default=500,
+                    help="Number of versions loaded and saved at once "
+                         "(default: 500)."),
+    )
+
+    def handle(self, *model_refs, **options):
+        batch_size = options['batch_size']
+        if batch_size < 1:
+            raise CommandError("Batch size needs to be positive")
+
+        try:
+            model_list = ([resolve_model(model_ref) for model_ref in model_refs]
+                          or reversion.get_registered_models())
+        except ValueError, e:
+            raise CommandError(str(e))
+        content_types = [ContentType.objects.get_for_model(model)
+                         for model in model_list]
+
+        versions = (models.Version.objects.filter(content_type__in=content_types)
+                                          .order_by('content_type', 'object_id',
+                                                    'id'))
+        version_ids = list(versions.values_list('id', flat=True))
+
+        count = changed_count = size_before = size_after = 0
+        previous = None
+        for idx in range(0, len(version_ids), batch_size):
+            batch = versions.filter(id__in=version_ids[idx:idx + batch_size])
+            changed = []
+            for version in batch:
+                if (previous is not None
+                    and (previous.content_type_id, previous.object_id)
+                         != (version.content_type_id, version.object_id)):
+                    previous = None
+
+                size_before += data_size(version.serialized_data)
+                if options['unpack']:
+                    is_changed = unpack_version(version)
+                else:
+                    is_changed = pack_version(version, previous)
+                if is_changed:
+                    # Keep compressed, if configured
+                    compress_version(version)
+                    changed.append(version)
+                size_after += data_size(version.serialized_data)
+
+                count += 1
+                previous = version
+            changed_count += self.save_batch(changed)
+
+        self.stdout.write("%s %d of %d versions, %s to %s (ratio %.1f)\n"
+                          % ("Unpacked" if options['unpack'] else "Packed",
+                             changed_count, count, format_size(size_before),
+                             format_size(size_after),
+                             float(size_before) / max(size_after, 1)))
+
+    @transaction.commit_on_success
+    def save_batch(self, versions):
+        for version in versions:
+            models.Version.objects.filter(id=version.id).update(
+                                       serialized_data=version.serialized_data)
+        return len(versions)
@@ -0,0 +1,136 @@
+import datetime
+from itertools import groupby
+from optparse import make_option
+
+from django.conf import settings
+from django.contrib.contenttypes.models import ContentType
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.utils import timezone
+import reversion
+from reversion import models
+
+from wikify import resolve_model
+from wikify.retention import delete_versions, prunable_versions
+
+def parse_days(value, option):
+    if value is None:
+        return None
+    if value < 0:
+        raise CommandError("%s needs to be zero or positive" % option)
+    return datetime.timedelta(days=value)
+
+class Command(BaseCommand):
+    args = '[module.Model ...]'
+    help = ("Deletes old versions of registered models, optionally only of "
+            "the given ones. All versions of the last days are kept, older "
+            "ones as hourly and daily snapshots. Versions with a comment and "
+            "the latest version of each page are always kept.")
+    option_list = BaseCommand.option_list + (
+        make_option('--keep-all', type='int', default=30, metavar='DAYS',
+                    help="Keep all versions of this many days (default: 30)."),
+        make_option('--keep-hourly', type='int', metavar='DAYS',
+                    help="Keep the latest version of every hour for versions "
+                         "up to this many days old (default: none)."),
+        make_option('--keep-daily', type='int', metavar='DAYS',
+                    help="Keep the latest version of every day for versions "
+                         "up to this many days old, delete older ones "
+                         "(default: no limit)."),
+        make_option('--page', action='append', dest='pages', default=[],
+                    help="Only prune versions of the page with this primary "
+                         "key, can be given several times."),
+        make_option('--batch-size', type='int', default=500,
+                    help="Number of versions deleted at once (default: 500)."),
+        make_option('--dry-run', action='store_true', default=False,
+                    help="Only report the number of versions to delete."),
+    )
+
+    def handle(self, *model_refs, **options):
+        batch_size = options['batch_size']
+        if batch_size < 1:
+            raise CommandError("Batch size needs to be positive")
+        keep_all = parse_days(options['keep_all'], '--keep-all')
+        keep_hourly = parse_days(options['keep_hourly'], '--keep-hourly')
+        keep_daily = parse_days(options['keep_daily'], '--keep-daily')
+
+        try:
+            model_list = ([resolve_model(model_ref) for model_ref in model_refs]
+                          or reversion.get_registered_models())
+        except ValueError, e:
+            raise CommandError(str(e))
+        content_types = [ContentType.objects.get_for_model(model)
+                         for model in model_list]
+
+        versions = models.Version.objects.filter(content_type__in=content_types)
+        if options['pages']:
+            versions = versions.filter(object_id__in=options['pages'])
+        versions = (versions.order_by('content_type', 'object_id', '-id')
+                            .values_list('content_type', 'object_id', 'id',
+                                         'revision__date_created',
+                                         'revision__comment'))
+
+        # Select all first, as deleting changes the versions iterated over
+        now = timezone.now()
+        batches = []
+        batch, kept_ids = [], []
+        following_ids = []
+        count = 0
+        for _, object_versions in groupby(versions.iterator(),
+                                          lambda row: row[:2]):
+            object_versions = [row[2:] for row in object_versions]
+            count += len(object_versions)
+            pruned = set(prunable_versions(object_versions, now, keep_all,
+                                           keep_hourly, keep_daily))
+            if not pruned:
+                continue
+            batch.extend(pruned)
+            kept_ids.extend(version_id for version_id, _, _ in object_versions
+                            if version_id not in pruned
+                               and version_id > min(pruned))
+            # Their diffs now compare to an older version
+            following_ids.extend(version_id for (version_id, _, _), previous
+                                 in zip(object_versions, object_versions[1:])
+                                 if version_id not in pruned
+                                    and previous[0] in pruned)
+            if len(batch) >= batch_size:
+                batches.append((batch, kept_ids))
+                batch, kept_ids = [], []
+        if batch:
+            batches.append((batch, kept_ids))
+        total = sum(len(batch) for batch, _ in batches)
+
+        if options['dry_run']:
+            self.stdout.write("Would delete %d of %d versions\n"
+                              % (total, count))
+            return
+
+        deleted = 0
+        for batch, kept_ids in batches:
+            # Batches hold whole pages, split large ones. Versions deleted
+            #   later still need to be readable until then
+            for idx in range(0, len(batch), batch_size):
+                deleted += self.delete_batch(batch[idx:idx + batch_size],
+                                             kept_ids
+                                             + batch[idx + batch_size:])
+                if int(options['verbosity']) > 1:
+                    self.stdout.write("%d/%d versions deleted\n"
+                                      % (deleted, total))
+
+        self.stdout.write("Deleted %d of %d versions\n" % (deleted, count))
+
+        max_age = getattr(settings, 'WIKIFY_VERSION_MAX_AGE', None)
+        if max_age is not None and deleted:
+            self.stdout.write("Versions and diffs are cached as immutable for "
+                              "%d seconds (WIKIFY_VERSION_MAX_AGE), purge the "
+                              "deleted versions and their diffs, and the "
+                              "diffs of %d versions following them from "
+                              "shared caches\n"
+                              % (max_age, len(following_ids)))
+            if int(options['verbosity']) > 1:
+                self.stdout.write("Changed diffs of versions: %s\n"
+                                  % ', '.join(str(version_id) for version_id
+                                              in sorted(following_ids)))
+
+    @transaction.commit_on_success
+    def delete_batch(self, version_ids, kept_ids):
+        return delete_versions(version_ids, kept_ids)
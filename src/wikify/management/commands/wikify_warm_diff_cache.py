@@ -0,0 +1,148 @@
+import datetime
+import multiprocessing
+from optparse import make_option
+import time
+
+from django.conf import settings
+from django.contrib.contenttypes.models import ContentType
+from django.core.cache.backends.locmem import LocMemCache
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.utils import timezone
+import reversion
+from reversion import models
+
+from wikify import resolve_model
+from wikify.cache import (get_diff_cache, reset_diff_caches, version_pairs,
+                          warm_diff_cache)
+from wikify.storage import reset_object_caches
+
+def init_worker():
+    # Connections of the parent process must not be shared
+    connection.close()
+    reset_diff_caches()
+    reset_object_caches()
+
+def warm_batch(args):
+    pairs, force = args
+    return len(pairs), warm_diff_cache(pairs, force=force)
+
+def parse_date(value, option):
+    try:
+        date = datetime.datetime.strptime(value, '%Y-%m-%d')
+    except ValueError:
+        raise CommandError("Invalid date %r for %s, use YYYY-MM-DD"
+                           % (value, option))
+    if settings.USE_TZ:
+        date = timezone.make_aware(date, timezone.get_default_timezone())
+    return date
+
+class Command(BaseCommand):
+    args = '[module.Model ...]'
+    help = ("Calculates the diffs between all consecutive versions of "
+            "registered models, optionally only of the given ones, and "
+            "stores them in the diff cache. Diffs already cached are skipped, "
+            "so an interrupted run can simply be started again.")
+    option_list = BaseCommand.option_list + (
+        make_option('--page', action='append', dest='pages', default=[],
+                    help="Only warm diffs of the page with this primary key, "
+                         "can be given several times."),
+        make_option('--since', help="Only warm diffs of versions saved on or "
+                                    "after this date (YYYY-MM-DD)."),
+        make_option('--until', help="Only warm diffs of versions saved before "
+                                    "this date (YYYY-MM-DD)."),
+        make_option('--processes', type='int',
+                    default=multiprocessing.cpu_count(),
+                    help="Number of worker processes (default: number of "
+                         "CPUs)."),
+        make_option('--batch-size', type='int', default=50,
+                    help="Number of versions handed to a worker at once "
+                         "(default: 50)."),
+        make_option('--force', action='store_true', default=False,
+                    help="Recalculate diffs that are already cached."),
+    )
+
+    def handle(self, *model_refs, **options):
+        if get_diff_cache() is None:
+            raise CommandError("No diff cache configured, set "
+                               "WIKIFY_DIFF_CACHE")
+        if options['processes'] < 1 or options['batch_size'] < 1:
+            raise CommandError("Processes and batch size need to be positive")
+        since = until = None
+        if options['since']:
+            since = parse_date(options['since'], '--since')
+        if options['until']:
+            until = parse_date(options['until'], '--until')
+
+        try:
+            model_list = ([resolve_model(model_ref) for model_ref in model_refs]
+                          or reversion.get_registered_models())
+        except ValueError, e:
+            raise CommandError(str(e))
+        content_types = [ContentType.objects.get_for_model(model)
+                         for model in model_list]
+
+        # Earlier versions are needed even if outside of the date range, so
+        #   only filter by object
+        versions = models.Version.objects.filter(content_type__in=content_types)
+        if options['pages']:
+            versions = versions.filter(object_id__in=options['pages'])
+        versions = (versions.order_by('content_type', 'object_id', 'id')
+                            .values_list('id', 'content_type', 'object_id',
+                                         'revision__date_created'))
+
+        pairs = [(content_type_id, old_version_id, new_version_id)
+                 for content_type_id, old_version_id, new_version_id, date
+                 in version_pairs(versions.iterator())
+                 if (since is None or date >= since)
+                    and (until is None or date < until)]
+        batch_size = options['batch_size']
+        batches = [(pairs[idx:idx + batch_size], options['force'])
+                   for idx in range(0, len(pairs), batch_size)]
+
+        processes = options['processes']
+        if processes > 1 and isinstance(get_diff_cache(), LocMemCache):
+            # Workers would only fill their own memory
+            self.stderr.write("The diff cache is local to each process, "
+                              "using a single process\n")
+            processes = 1
+
+        start = time.time()
+        if processes > 1 and len(batches) > 1:
+            connection.close()
+            pool = multiprocessing.Pool(processes,
+                                        initializer=init_worker)
+            try:
+                results = pool.imap_unordered(warm_batch, batches)
+                version_count, diff_count = self.collect(results, len(pairs),
+                                                         start, options)
+                pool.close()
+            except:
+                pool.terminate()
+                raise
+            finally:
+                pool.join()
+        else:
+            version_count, diff_count = self.collect(
+                                                  (warm_batch(batch)
+                                                   for batch in batches),
+                                                  len(pairs), start, options)
+
+        duration = max(time.time() - start, 1e-6)
+        self.stdout.write("Calculated %d diffs for %d versions in %.1f s "
+                          "(%.1f versions/s, %.1f diffs/s)\n"
+                          % (diff_count, version_count, duration,
+                             version_count / duration,
+                             diff_count / duration))
+
+    def collect(self, results, total, start, options):
+        version_count = diff_count = 0
+        for batch_versions, batch_diffs in results:
+            version_count += batch_versions
+            diff_count += batch_diffs
+            if int(options['verbosity']) > 1:
+                self.stdout.write("%d/%d versions, %.1f versions/s\n"
+                                  % (version_count, total,
+                                     version_count
+                                     / max(time.time() - start, 1e-6)))
+        return version_count, diff_count
@@ -4,3 +4,20 @@ class VersionMeta(models.Model):
     """ Additional meta data for revisions. """
     revision = models.ForeignKey("reversion.Revision")
     ip_address = models.IPAddressField()
+
+class VersionStats(models.Model):
+    """
+    Size of the changes made in a version, to show in the history without
+    calculating diffs. Only stored if the WIKIFY_VERSION_STATS setting is
+    enabled, see wikify.stats.
+    """
+    version = models.OneToOneField("reversion.Version",
+                                   related_name="wikify_stats")
+    lines_added = models.PositiveIntegerField(default=0)
+    lines_removed = models.PositiveIntegerField(default=0)
+    # Comma separated names of the changed fields
+    changed_fields = models.TextField(blank=True)
+    byte_delta = models.IntegerField(default=0)
+
+    def get_changed_fields(self):
+        return self.changed_fields.split(',') if self.changed_fields else []
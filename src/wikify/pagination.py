@@ -0,0 +1,77 @@
+"""
+Pagination of versions by version id (keyset pagination).
+
+Django's Paginator needs to count all versions and skips over older entries
+with an offset, both of which get slow on long histories. A CursorPage instead
+selects the versions before or after a given version id, which only touches
+the rows shown.
+"""
+
+class CursorPage(object):
+    """
+    A page of versions, newest first, selected by version id.
+
+    Offers object_list, has_next, has_previous and has_other_pages like
+    Django's Page. The page number and page count are unknown, instead
+    next_before and previous_after give the version ids to link to.
+    """
+    cursor = True
+
+    def __init__(self, object_list, next_before=None, previous_after=None):
+        self.object_list = object_list
+        self.next_before = next_before
+        self.previous_after = previous_after
+
+    def __len__(self):
+        return len(self.object_list)
+
+    def __iter__(self):
+        return iter(self.object_list)
+
+    def has_next(self):
+        return self.next_before is not None
+
+    def has_previous(self):
+        return self.previous_after is not None
+
+    def has_other_pages(self):
+        return self.has_next() or self.has_previous()
+
+def cursor_page(versions, per_page, before=None, after=None):
+    """
+    Returns the CursorPage of versions older than the version with id before,
+    or newer than the one with id after. Without either the newest versions
+    are returned.
+
+    The ordering of the given versions is replaced, but they must not have been
+    reversed (QuerySet.reverse() also flips any later ordering).
+    """
+    if after is not None:
+        object_list = list(versions.filter(id__gt=after)
+                                   .order_by('id')[:per_page + 1])
+        has_newer = len(object_list) > per_page
+        object_list = object_list[:per_page]
+        object_list.reverse()
+        has_older = versions.filter(id__lte=after).exists()
+    else:
+        if before is not None:
+            versions_before = versions.filter(id__lt=before)
+        else:
+            versions_before = versions
+        object_list = list(versions_before.order_by('-id')[:per_page + 1])
+        has_older = len(object_list) > per_page
+        object_list = object_list[:per_page]
+        has_newer = (before is not None
+                     and versions.filter(id__gte=before).exists())
+
+    # Empty pages (e.g. for a stale link) still link to their neighbours
+    if object_list:
+        oldest_id, newest_id = object_list[-1].id, object_list[0].id
+    elif after is not None:
+        oldest_id = newest_id = after + 1
+    else:
+        oldest_id = newest_id = before - 1 if before is not None else None
+
+    return CursorPage(object_list,
+                      next_before=oldest_id if has_older else None,
+                      previous_after=newest_id if has_newer else None)
@@ -0,0 +1,142 @@
+"""
+Retention of versions: thinning out long histories to snapshots.
+
+Recent versions are all kept, older ones only as hourly and then daily
+snapshots (the latest version of each hour or day). Versions with a comment
+and the latest version of an instance are always kept.
+"""
+
+from django.contrib.contenttypes.models import ContentType
+from reversion import models
+
+from wikify.models import VersionStats
+
+from wikify.storage import (compress_version, decompress, parse_delta,
+                            unpack_version, version_data)
+
+QUERY_CHUNK_SIZE = 500
+
+def get_snapshot_bucket(date, age, keep_hourly):
+    if keep_hourly is not None and age < keep_hourly:
+        return date.replace(minute=0, second=0, microsecond=0)
+    return date.date()
+
+def prunable_versions(versions, now, keep_all, keep_hourly=None,
+                      keep_daily=None):
+    """
+    Yields the ids of the versions to delete, given the versions of a single
+    instance as (id, date, comment) tuples, newest first.
+
+    All versions younger than keep_all are kept, older ones younger than
+    keep_hourly (if given) as hourly snapshots, and the rest as daily
+    snapshots. Versions older than keep_daily (if given) are deleted. All ages
+    are timedeltas.
+    """
+    seen_buckets = set()
+    for idx, (version_id, date, comment) in enumerate(versions):
+        age = now - date
+        if age < keep_all:
+            continue
+        # Kept anyway, but still the snapshot of their hour or day
+        always_kept = idx == 0 or comment
+        if keep_daily is not None and age >= keep_daily:
+            if not always_kept:
+                yield version_id
+            continue
+        bucket = get_snapshot_bucket(date, age, keep_hourly)
+        if bucket in seen_buckets and not always_kept:
+            yield version_id
+        seen_buckets.add(bucket)
+
+def following_versions(version_ids, kept_ids):
+    """
+    Returns the ids of the kept versions right after a deleted version of the
+    same instance.
+    """
+    rows = []
+    ids = sorted(set(version_ids) | set(kept_ids))
+    for idx in range(0, len(ids), QUERY_CHUNK_SIZE):
+        rows.extend(models.Version.objects.filter(
+                                        id__in=ids[idx:idx + QUERY_CHUNK_SIZE])
+                                          .values_list('content_type_id',
+                                                       'object_id', 'id'))
+    following = []
+    previous = None
+    for row in sorted(rows):
+        if (previous is not None and previous[:2] == row[:2]
+            and previous[2] in version_ids and row[2] not in version_ids):
+            following.append(row[2])
+        previous = row
+    return following
+
+def update_version_stats(version_ids):
+    """
+    Stores the stats of the given versions anew, compared to the version now
+    before each of them. Versions without stats are skipped.
+    """
+    # Stats need diff_match_patch, only import when used
+    from wikify.stats import build_version_stats
+
+    with_stats = set()
+    for idx in range(0, len(version_ids), QUERY_CHUNK_SIZE):
+        with_stats.update(VersionStats.objects.filter(
+                            version__in=version_ids[idx:idx + QUERY_CHUNK_SIZE])
+                                              .values_list('version_id',
+                                                           flat=True))
+    for version in models.Version.objects.filter(id__in=sorted(with_stats)):
+        model = ContentType.objects.get_for_id(
+                                          version.content_type_id).model_class()
+        if model is None:
+            continue
+        previous = list(models.Version.objects.filter(
+                                        content_type=version.content_type_id,
+                                        object_id=version.object_id,
+                                        id__lt=version.id)
+                                              .order_by('-id')[:1])
+        stats = build_version_stats(model, previous[0] if previous else None,
+                                    version)
+        VersionStats.objects.filter(version=version).delete()
+        stats.save()
+
+def delete_versions(version_ids, kept_ids=()):
+    """
+    Deletes the versions with the given ids, together with their stats and the
+    revisions (with their VersionMeta) left without versions.
+
+    Kept versions stored as delta to a deleted version are stored in full
+    first, and their stats now compare to the version before the deleted
+    ones. kept_ids gives the versions to check, all kept versions of the same
+    instances newer than a deleted one.
+    """
+    version_ids = set(version_ids)
+    kept_ids = sorted(kept_ids)
+    restated_ids = following_versions(version_ids, kept_ids)
+    rebased = []
+    # In chunks, databases limit the number of query parameters
+    for idx in range(0, len(kept_ids), QUERY_CHUNK_SIZE):
+        # Versions stored as delta or compressed, these can only be told
+        #   apart after decompressing
+        encoded = models.Version.objects.filter(
+                            id__in=kept_ids[idx:idx + QUERY_CHUNK_SIZE],
+                            serialized_data__startswith='wikify-')
+        for version in encoded:
+            delta = parse_delta(decompress(version.serialized_data))
+            if delta is not None and delta[0] in version_ids:
+                # Read while the base version still exists
+                version_data(version)
+                rebased.append(version)
+    for version in rebased:
+        unpack_version(version)
+        compress_version(version)
+        models.Version.objects.filter(id=version.id).update(
+                                       serialized_data=version.serialized_data)
+
+    revision_ids = set(models.Version.objects.filter(id__in=list(version_ids))
+                                             .values_list('revision_id',
+                                                          flat=True))
+    models.Version.objects.filter(id__in=list(version_ids)).delete()
+    # Deletes the VersionMeta of the revisions, too
+    models.Revision.objects.filter(id__in=list(revision_ids),
+                                   version__isnull=True).delete()
+    update_version_stats(restated_ids)
+    return len(version_ids)
@@ -0,0 +1,66 @@
+"""
+Change statistics of versions (lines added and removed, changed fields and the
+change in size), stored in VersionStats so the history can show them without
+diffing.
+"""
+
+from django.contrib.contenttypes.models import ContentType
+from django.utils.encoding import force_unicode
+from reversion import models
+
+from wikify.diff_utils import line_change_counts
+from wikify.models import VersionStats
+from wikify.utils import VersionFields
+
+def text_value(value):
+    return force_unicode(value) if value is not None else u''
+
+def build_version_stats(model, old_version, new_version):
+    """
+    Returns the (unsaved) VersionStats of the change from old to new version,
+    old version is None for the first version.
+    """
+    stats = VersionStats(version=new_version)
+    changed_fields = VersionFields(model, old_version, new_version).changed()
+    for field, old_value, new_value in changed_fields:
+        old_text, new_text = text_value(old_value), text_value(new_value)
+        added, removed = line_change_counts(old_text, new_text)
+        stats.lines_added += added
+        stats.lines_removed += removed
+        stats.byte_delta += (len(new_text.encode('utf-8'))
+                             - len(old_text.encode('utf-8')))
+    stats.changed_fields = ','.join(field.name
+                                    for field in changed_fields.fields)
+    return stats
+
+def save_latest_version_stats(model, object_id):
+    """Stores the stats of the latest version of the given instance."""
+    latest = list(models.Version.objects.get_for_object_reference(model,
+                                                                  object_id)
+                                        .order_by('-id')[:2])
+    if not latest:
+        return None
+    new_version = latest[0]
+    old_version = latest[1] if len(latest) > 1 else None
+    stats = build_version_stats(model, old_version, new_version)
+    VersionStats.objects.filter(version=new_version).delete()
+    stats.save()
+    return stats
+
+def iter_missing_version_stats(versions, existing_ids=()):
+    """
+    Yields the (unsaved) stats of the versions whose id is not among the
+    existing ids. Versions need to be ordered by content type, object and id.
+    """
+    previous = None
+    for version in versions:
+        if (previous is not None
+            and (previous.content_type_id, previous.object_id)
+                 != (version.content_type_id, version.object_id)):
+            previous = None
+        if version.id not in existing_ids:
+            model = ContentType.objects.get_for_id(
+                                          version.content_type_id).model_class()
+            if model is not None:
+                yield build_version_stats(model, previous, version)
+        previous = version
@@ -0,0 +1,354 @@
+"""
+Storage of versions as deltas to the previous version, and compressed.
+
+Reversion stores a full copy of the serialized instance with every version, so
+the history of a large page grows with its size times the number of edits.
+With WIKIFY_DELTA_STORAGE set the serialized data of a new version is replaced
+by the changes to the previous version of the same instance. Every
+WIKIFY_DELTA_KEYFRAME_INTERVAL versions a full copy (a keyframe) is kept, so
+reading a version never needs more than that many versions.
+
+With WIKIFY_COMPRESSION set to 'zlib' or 'lzma' the serialized data (a full
+copy or a delta) is stored compressed, encoded as base64 text.
+
+Deltas and compressed data are read by version_data() and version_object(),
+reversion itself (e.g. Version.object_version used by its admin) does not know
+about them. Run ``python manage.py wikify_pack_history --unpack`` to restore
+full copies, and ``python manage.py wikify_compress_history`` without
+WIKIFY_COMPRESSION set to store them uncompressed.
+
+Deserialized instances can be kept in a process-local LRU cache of
+WIKIFY_OBJECT_CACHE_SIZE entries, and in the Django cache given by
+WIKIFY_OBJECT_CACHE, see version_object().
+"""
+
+import base64
+from collections import OrderedDict
+import threading
+import zlib
+
+try:
+    import lzma
+except ImportError:
+    try:
+        from backports import lzma
+    except ImportError:
+        lzma = None
+
+from django.conf import settings
+from django.core import serializers
+from django.core.cache import get_cache
+from django.core.exceptions import ImproperlyConfigured
+from reversion import models
+
+# Start of the serialized data of a version stored as delta, followed by
+#   "<base version id>:<number of deltas down to the keyframe>:<delta>"
+DELTA_PREFIX = u'wikify-delta:'
+
+DEFAULT_KEYFRAME_INTERVAL = 20
+
+# Seconds for calculating a delta, a quicker one is only less compact
+DELTA_TIMEOUT = 1.0
+
+# Start of compressed serialized data, by compression method
+COMPRESSION_PREFIXES = {'zlib': u'wikify-zlib:',
+                        'lzma': u'wikify-lzma:'}
+
+# Cache key of a deserialized version, by version id and checksum of the data,
+#   as ids of deleted versions may be used again
+OBJECT_CACHE_KEY = 'wikify:object:%d:%08x'
+
+class LRUCache(object):
+    """
+    Thread-safe mapping of at most size entries, dropping the least recently
+    used entry first.
+    """
+    def __init__(self, size):
+        self.size = size
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key, default=None):
+        with self.lock:
+            try:
+                value = self.entries.pop(key)
+            except KeyError:
+                return default
+            self.entries[key] = value
+            return value
+
+    def set(self, key, value):
+        with self.lock:
+            self.entries.pop(key, None)
+            self.entries[key] = value
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+_object_caches = {}
+
+def get_object_caches():
+    """
+    Returns the process-local LRU cache and the shared cache for deserialized
+    versions, each None if not configured.
+    """
+    size = getattr(settings, 'WIKIFY_OBJECT_CACHE_SIZE', 0)
+    local_cache = _object_caches.get('local')
+    if not size:
+        local_cache = None
+    elif local_cache is None or local_cache.size != size:
+        local_cache = _object_caches['local'] = LRUCache(size)
+
+    alias = getattr(settings, 'WIKIFY_OBJECT_CACHE', None)
+    shared_cache = None
+    if alias:
+        if alias not in _object_caches:
+            _object_caches[alias] = get_cache(alias)
+        shared_cache = _object_caches[alias]
+    return local_cache, shared_cache
+
+def reset_object_caches():
+    """Drops all cached versions and cache connections."""
+    _object_caches.clear()
+
+def get_keyframe_interval():
+    return getattr(settings, 'WIKIFY_DELTA_KEYFRAME_INTERVAL',
+                   DEFAULT_KEYFRAME_INTERVAL)
+
+def get_compression():
+    """Returns the compression method and level to store versions with."""
+    method = getattr(settings, 'WIKIFY_COMPRESSION', None)
+    if method not in COMPRESSION_PREFIXES and method is not None:
+        raise ImproperlyConfigured("WIKIFY_COMPRESSION needs to be one of "
+                                   "'zlib', 'lzma' or None, not %r" % method)
+    if method == 'lzma' and lzma is None:
+        raise ImproperlyConfigured("WIKIFY_COMPRESSION 'lzma' needs the lzma "
+                                   "module (backports.lzma on Python 2)")
+    return method, getattr(settings, 'WIKIFY_COMPRESSION_LEVEL', None)
+
+def compress(data, method, level=None):
+    data = data.encode('utf-8')
+    if method == 'zlib':
+        compressed = zlib.compress(data, 6 if level is None else level)
+    else:
+        compressed = lzma.compress(data,
+                                   **({} if level is None
+                                      else {'preset': level}))
+    return COMPRESSION_PREFIXES[method] + base64.b64encode(compressed)
+
+def decompress(data):
+    """Returns the serialized data (or delta) of compressed data."""
+    for method, prefix in COMPRESSION_PREFIXES.items():
+        if data.startswith(prefix):
+            compressed = base64.b64decode(data[len(prefix):])
+            if method == 'zlib':
+                data = zlib.decompress(compressed)
+            else:
+                if lzma is None:
+                    raise ImproperlyConfigured("Version data compressed with "
+                                               "lzma needs the lzma module")
+                data = lzma.decompress(compressed)
+            return data.decode('utf-8')
+    return data
+
+def recompress(data):
+    """
+    Returns the stored data compressed by the configured method, or
+    uncompressed without one. Data is left uncompressed if compressing would
+    not save space.
+    """
+    data = decompress(data)
+    method, level = get_compression()
+    if method is not None:
+        compressed = compress(data, method, level)
+        if len(compressed) < len(data):
+            return compressed
+    return data
+
+def parse_delta(data):
+    """
+    Returns base version id, depth and delta of the serialized data of a
+    version stored as delta, or None for a full copy.
+    """
+    if not data.startswith(DELTA_PREFIX):
+        return None
+    base_id, depth, delta = data[len(DELTA_PREFIX):].split(':', 2)
+    return int(base_id), int(depth), delta
+
+def get_depth(data):
+    """Returns the number of deltas from the last keyframe to the data."""
+    delta = parse_delta(data)
+    return delta[1] if delta is not None else 0
+
+def encode_delta(base_id, depth, base_data, data):
+    # Storing deltas needs diff_match_patch, only import when used
+    from diff_match_patch import diff_match_patch
+    dmp = diff_match_patch()
+    dmp.Diff_Timeout = DELTA_TIMEOUT
+    delta = dmp.diff_toDelta(dmp.diff_main(base_data, data, False))
+    return u'%s%d:%d:%s' % (DELTA_PREFIX, base_id, depth, delta)
+
+def apply_delta(base_data, delta):
+    from diff_match_patch import diff_match_patch
+    dmp = diff_match_patch()
+    return dmp.diff_text2(dmp.diff_fromDelta(base_data, delta))
+
+def version_data(version):
+    """
+    Returns the serialized data of the version, decompressing it and applying
+    deltas. The data is kept on the version, so it is only reconstructed once
+    and only when needed.
+    """
+    data = getattr(version, '_wikify_data', None)
+    if data is None:
+        data = version._wikify_data = decode_version_data(version)
+    return data
+
+def decode_version_data(version):
+    data = decompress(version.serialized_data)
+    delta = parse_delta(data)
+    if delta is None:
+        return data
+
+    # Deltas are based on the previous versions of the same instance, fetch
+    #   these down to the keyframe at once
+    base_id, depth, _ = delta
+    rows = dict(models.Version.objects.filter(
+                                        content_type=version.content_type_id,
+                                        object_id=version.object_id,
+                                        id__lte=base_id)
+                                      .order_by('-id')
+                                      .values_list('id', 'serialized_data')
+                                      [:depth])
+
+    deltas = []
+    while delta is not None:
+        base_id, _, patch = delta
+        deltas.append(patch)
+        if base_id not in rows:
+            rows.update(models.Version.objects.filter(id=base_id)
+                                              .values_list('id',
+                                                           'serialized_data'))
+        if base_id not in rows:
+            raise models.Version.DoesNotExist("Base version %d of version %d "
+                                              "not found"
+                                              % (base_id, version.id))
+        data = decompress(rows[base_id])
+        delta = parse_delta(data)
+
+    for patch in reversed(deltas):
+        data = apply_delta(data, patch)
+    return data
+
+def version_object(version):
+    """
+    Returns the instance stored in the version, like reversion's
+    version.object_version.object but also for versions stored as delta or
+    compressed.
+
+    If an object cache is configured, the instance is only deserialized once
+    and shared between callers, who must not change it.
+    """
+    local_cache, shared_cache = get_object_caches()
+    if local_cache is None and shared_cache is None:
+        return deserialize_version(version)
+
+    key = OBJECT_CACHE_KEY % (version.id,
+                              zlib.crc32(version.serialized_data
+                                                .encode('utf-8')) & 0xffffffff)
+    instance = local_cache.get(key) if local_cache is not None else None
+    if instance is None and shared_cache is not None:
+        instance = shared_cache.get(key)
+        if instance is not None and local_cache is not None:
+            local_cache.set(key, instance)
+    if instance is None:
+        instance = deserialize_version(version)
+        if local_cache is not None:
+            local_cache.set(key, instance)
+        if shared_cache is not None:
+            shared_cache.set(key, instance)
+    return instance
+
+def deserialize_version(version):
+    data = version_data(version)
+    if isinstance(data, unicode):
+        data = data.encode('utf8')
+    return list(serializers.deserialize(version.format, data))[0].object
+
+def pack_version(version, previous):
+    """
+    Stores the version as delta to the previous version of the same instance,
+    unless a keyframe is due or the delta is not smaller than the full copy.
+
+    Only changes serialized_data, returns whether the version needs saving.
+    """
+    if (previous is None or previous.format != version.format
+        or parse_delta(decompress(version.serialized_data)) is not None):
+        return False
+    depth = get_depth(decompress(previous.serialized_data)) + 1
+    if depth >= get_keyframe_interval():
+        return False
+
+    data = version_data(version)
+    packed = encode_delta(previous.id, depth, version_data(previous), data)
+    if len(packed) >= len(data):
+        return False
+    version.serialized_data = packed
+    return True
+
+def unpack_version(version):
+    """
+    Stores the full copy of a version stored as delta. Returns whether the
+    version needs saving.
+    """
+    if parse_delta(decompress(version.serialized_data)) is None:
+        return False
+    version.serialized_data = version_data(version)
+    return True
+
+def compress_version(version):
+    """
+    Stores the data of the version compressed as configured (or uncompressed).
+    Returns whether the version needs saving.
+    """
+    data = recompress(version.serialized_data)
+    if data == version.serialized_data:
+        return False
+    version.serialized_data = data
+    return True
+
+def data_size(data):
+    """Returns the stored size of serialized data in bytes."""
+    return len(data.encode('utf-8'))
+
+def format_size(size):
+    return "%.1f MB" % (size / (1024.0 * 1024))
+
+def encode_latest_version(model, object_id):
+    """
+    Stores the latest version of the given instance as delta and compressed,
+    as configured by WIKIFY_DELTA_STORAGE and WIKIFY_COMPRESSION.
+    """
+    delta_storage = getattr(settings, 'WIKIFY_DELTA_STORAGE', False)
+    if not delta_storage and get_compression()[0] is None:
+        return False
+
+    latest = list(models.Version.objects.get_for_object_reference(model,
+                                                                  object_id)
+                                        .order_by('-id')[:2])
+    if not latest:
+        return False
+    version = latest[0]
+    previous = latest[1] if len(latest) > 1 else None
+    changed = delta_storage and pack_version(version, previous)
+    if not compress_version(version) and not changed:
+        return False
+    models.Version.objects.filter(id=version.id).update(
+                                       serialized_data=version.serialized_data)
+    return True
@@ -1,16 +1,122 @@
+from django.conf import settings
 from django.template import Library, Node, TemplateSyntaxError, Variable, VariableDoesNotExist
-from django.template.loader import render_to_string
+from django.template.loader import get_template
 from django.utils.encoding import force_unicode
+from django.utils.translation import ugettext
 
-from wikify.diff_utils import side_by_side_diff, context_diff
+from wikify.cache import cached_context_diff, diff_cache_key
 
 register = Library()
 
+# Rows as rendered by wikify/contextual_diff_tr.html
+DEGRADED_ROW = u'<tr class="wikify-degraded"><td colspan="4">%s</td></tr>\n'
+LINENO_ROW = (u'<tr class="wikify-lineno"><td colspan="2">%s</td>'
+              u'<td colspan="2">%s</td></tr>\n')
+UNCHANGED_ROW = (u'<tr class="wikify-nochange">'
+                 u'<td class="wikify-changestatus"></td>'
+                 u'<td class="wikify-diffcontent wikify-left">%s</td>'
+                 u'<td class="wikify-changestatus"></td>'
+                 u'<td class="wikify-diffcontent wikify-right">%s</td></tr>\n')
+CHANGED_ROW = (u'<tr class="wikify-change">%s%s</tr>\n')
+CHANGED_LEFT = (u'<td class="wikify-changestatus">-</td>'
+                u'<td class="wikify-diffcontent wikify-left">%s</td>')
+CHANGED_RIGHT = (u'<td class="wikify-changestatus">+</td>'
+                 u'<td class="wikify-diffcontent wikify-right">%s</td>')
+MISSING_LEFT = (u'<td class="wikify-changestatus"></td>'
+                u'<td class="wikify-left"></td>')
+MISSING_RIGHT = (u'<td class="wikify-changestatus"></td>'
+                 u'<td class="wikify-right"></td>')
+
+def render_degraded_row():
+    return DEGRADED_ROW % ugettext("This difference was too expensive to "
+                                   "calculate in detail and is shown by whole "
+                                   "lines only.")
+
+def render_hunk_rows(hunk, line_label=None):
+    """
+    Renders the rows of one hunk of a context diff, giving the same HTML as
+    wikify/contextual_diff_tr.html without going through the template engine.
+    """
+    left_line_idx, right_line_idx, lines = hunk
+    if line_label is None:
+        line_label = ugettext("Line %(line)s")
+    rows = [LINENO_ROW % (line_label % {'line': left_line_idx + 1},
+                          line_label % {'line': right_line_idx + 1})]
+    append = rows.append
+    for left, right in lines:
+        if left == right:
+            append(UNCHANGED_ROW % (left, right))
+        else:
+            append(CHANGED_ROW % (
+                        MISSING_LEFT if left is None else CHANGED_LEFT % left,
+                        MISSING_RIGHT if right is None
+                                      else CHANGED_RIGHT % right))
+    return u''.join(rows)
+
+def context_diff_rows(old_value, new_value, context, context_width=2,
+                      cache_key=None):
+    """
+    Renders the table rows of a contextual diff between two values, yielding
+    them change by change. Nothing is rendered for equal values.
+    """
+    old_text = force_unicode(old_value) if old_value else ''
+    new_text = force_unicode(new_value) if new_value else ''
+    if old_text == new_text:
+        return iter([])
+    contextual_diff, degraded = cached_context_diff(old_text, new_text,
+                                                    context=context_width,
+                                                    key=cache_key)
+    return render_diff_rows(contextual_diff, degraded, context)
+
+def render_diff_rows(contextual_diff, degraded, context):
+    """
+    Renders the table rows of the given context diff hunks, yielding them hunk
+    by hunk.
+
+    Rows are built in Python, unless a template is set with the
+    WIKIFY_DIFF_ROWS_TEMPLATE setting (see wikify/contextual_diff_tr.html).
+    """
+    rows_template = getattr(settings, 'WIKIFY_DIFF_ROWS_TEMPLATE', None)
+    if not rows_template:
+        if degraded:
+            yield render_degraded_row()
+        line_label = ugettext("Line %(line)s")
+        for hunk in contextual_diff:
+            yield render_hunk_rows(hunk, line_label)
+        return
+
+    template = get_template(rows_template)
+    if degraded:
+        context.update({'context_diff': [], 'degraded': True})
+        yield template.render(context)
+        context.pop()
+    for hunk in contextual_diff:
+        context.update({'context_diff': [hunk], 'degraded': False})
+        yield template.render(context)
+        context.pop()
+
 class ContextualDiffNode(Node):
-    def __init__(self, old_value, new_value, context_width=2):
+    def __init__(self, old_value, new_value, context_width='2',
+                 old_version=None, new_version=None, field=None):
         self.old_value = Variable(old_value)
         self.new_value = Variable(new_value)
-        self.context_width = context_width
+        self.context_width = Variable(context_width)
+        self.cache_key_vars = None
+        if field is not None:
+            self.cache_key_vars = (Variable(old_version),
+                                   Variable(new_version),
+                                   Variable(field))
+
+    def get_cache_key(self, context, context_width):
+        if not self.cache_key_vars:
+            return None
+        try:
+            old_version, new_version, field = [var.resolve(context) for var
+                                               in self.cache_key_vars]
+        except VariableDoesNotExist:
+            return None
+        return diff_cache_key(old_version, new_version, field.name,
+                              context_width)
 
     def render(self, context):
         try:
@@ -24,17 +130,12 @@ class ContextualDiffNode(Node):
             raise TemplateSyntaxError('"cache" tag got an unknown variable: %r'
                                       % self.old_value)
 
-        old_text = force_unicode(old_value) if old_value else ''
-        new_text = force_unicode(new_value) if new_value else ''
-        diff = side_by_side_diff(old_text, new_text)
-        contextual_diff = context_diff(diff, context=self.context_width)
-
-        context.push()
-        diff_str = render_to_string('wikify/contextual_diff_tr.html',
-                                    {'context_diff': contextual_diff},
-                                    context)
-        context.pop()
-        return diff_str
+        context_width = int(self.context_width.resolve(context))
+        return ''.join(context_diff_rows(
+                                 old_value, new_value, context,
+                                 context_width=context_width,
+                                 cache_key=self.get_cache_key(context,
+                                                              context_width)))
 
 
 def do_context_diff_tr(parser, token):
@@ -50,12 +151,32 @@ def do_context_diff_tr(parser, token):
                 {% context_diff_tr old_value new_value [context_width]%}
             </body>
         </table>
+
+    When given the versions and the field the values belong to, the diff is
+    looked up in and stored to the diff cache (see wikify.cache)::
+
+        {% context_diff_tr old_value new_value for old_version new_version field %}
     """
-    parser.delete_first_token()
     tokens = token.contents.split()
     if len(tokens) < 3:
         raise TemplateSyntaxError(u"'%r' tag requires at least 2 arguments."
                                   % tokens[0])
-    return ContextualDiffNode(tokens[1], tokens[2], *tokens[3:])
+    args = tokens[3:]
+    old_version = new_version = field = None
+    if 'for' in args:
+        idx = args.index('for')
+        args, cache_args = args[:idx], args[idx + 1:]
+        if len(cache_args) != 3:
+            raise TemplateSyntaxError(u"'%r' tag requires old version, new "
+                                      u"version and field after 'for'."
+                                      % tokens[0])
+        old_version, new_version, field = cache_args
+    if len(args) > 1:
+        raise TemplateSyntaxError(u"'%r' tag got too many arguments."
+                                  % tokens[0])
+    return ContextualDiffNode(tokens[1], tokens[2], *args,
+                              old_version=old_version,
+                              new_version=new_version,
+                              field=field)
 
 register.tag('context_diff_tr', do_context_diff_tr)
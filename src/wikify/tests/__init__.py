@@ -1,3 +1,7 @@
 from wikify.tests.template_tests import *
 from wikify.tests.view_tests import *
 from wikify.tests.diff_tests import *
+from wikify.tests.utils_tests import *
+from wikify.tests.stats_tests import *
+from wikify.tests.storage_tests import *
+from wikify.tests.retention_tests import *
@@ -1,13 +1,27 @@
+import datetime
 import itertools
+import random
+from StringIO import StringIO
 
+import fudge
 from django.utils import unittest
+from django.test import TestCase
+from django.test.utils import override_settings
+from django.core.cache import cache
+from django.core.management import call_command
+from django.core.exceptions import ImproperlyConfigured
+
+from wikify.tests.view_tests import construct_versions
 
 try:
-    from wikify.diff_utils import side_by_side_diff, context_diff
+    from wikify.diff_utils import (side_by_side_diff, context_diff,
+                                   compact_context_diff, context_hunks)
 except ImportError:
     can_test_diff = False
 else:
     can_test_diff = True
+    from wikify.cache import cached_context_diff, diff_cache_key, version_pairs
+    from wikify.executor import get_pool, use_executor, TimeoutError
 
 @unittest.skipUnless(can_test_diff, "Diff match patch library not installed")
 class SideBySideDiffTest(unittest.TestCase):
@@ -118,6 +132,188 @@ class SideBySideDiffTest(unittest.TestCase):
                           (None, "<ins>and</ins> words")])
 
 
+@unittest.skipUnless(can_test_diff, "Diff match patch library not installed")
+class LineModeSideBySideDiffTest(unittest.TestCase):
+    def assertSameAsCharacterDiff(self, old_text, new_text):
+        self.assertEqual(list(side_by_side_diff(old_text, new_text,
+                                                line_mode=True)),
+                         list(side_by_side_diff(old_text, new_text,
+                                                line_mode=False)))
+
+    def test_one_line_with_change(self):
+        self.assertSameAsCharacterDiff("old text", "new text")
+
+    def test_empty_text_with_insertion(self):
+        self.assertSameAsCharacterDiff("", "new")
+
+    def test_text_with_full_deletion(self):
+        self.assertSameAsCharacterDiff("old", "")
+
+    def test_line_insertion_at_beginning(self):
+        self.assertSameAsCharacterDiff("line", "new text\nline")
+
+    def test_line_insertion_at_end(self):
+        self.assertSameAsCharacterDiff("line", "line\nnew text")
+
+    def test_line_insertion_in_middle(self):
+        self.assertSameAsCharacterDiff("line\nanother line",
+                                       "line\nnew text\nanother line")
+
+    def test_inserted_newline_with_text_change(self):
+        self.assertSameAsCharacterDiff("a long line with words",
+                                       "a long line\nand words")
+
+    def test_change_in_common_prefix_line(self):
+        self.assertSameAsCharacterDiff("line 1\nline 2\nline 3",
+                                       "line 1\nline 2 changed\nline 3")
+
+    def test_change_in_common_suffix_line(self):
+        self.assertSameAsCharacterDiff("line 1\nline 2\nline 3",
+                                       "line 1\nnew line 2\nline 3")
+
+    def test_windows_line_endings(self):
+        self.assertSameAsCharacterDiff("line 1\r\nline 2\r\nline 3",
+                                       "line 1\r\nline two\r\nline 3")
+
+    def test_scattered_changes_in_long_text(self):
+        lines = [("line %d" % i) for i in range(2000)]
+        changed_lines = list(lines)
+        changed_lines[10] = 'changed line'
+        changed_lines[1500] = 'line 1500 changed'
+
+        diff = list(side_by_side_diff('\n'.join(lines),
+                                      '\n'.join(changed_lines)))
+
+        self.assertEqual(len(diff), 2000)
+        self.assertEqual(diff[10], ("line<del> 10</del>",
+                                    "<ins>changed </ins>line"))
+        self.assertEqual(diff[1500], ("line 1500", "line 1500<ins> changed</ins>"))
+        self.assertEqual(diff[1999], ("line 1999", "line 1999"))
+
+
+@unittest.skipUnless(can_test_diff, "Diff match patch library not installed")
+class LineOpcodesTest(unittest.TestCase):
+    def spans(self, old_text, new_text):
+        opcodes = side_by_side_diff(old_text, new_text).opcodes()
+        return list(opcodes.span_lines(old_text, new_text))
+
+    def test_changed_line(self):
+        self.assertEqual(self.spans("a line", "a row"),
+                         [([(0, 'a '), (-1, 'line')], [(0, 'a '), (1, 'row')])])
+
+    def test_inserted_empty_line(self):
+        self.assertEqual(self.spans("a\nb", "a\n\nb"),
+                         [([(0, 'a')], [(0, 'a')]),
+                          (None, []),
+                          ([(0, 'b')], [(0, 'b')])])
+
+    def test_text_is_not_escaped(self):
+        self.assertEqual(self.spans("<b>", "<i>"),
+                         [([(0, '<'), (-1, 'b'), (0, '>')],
+                           [(0, '<'), (1, 'i'), (0, '>')])])
+
+    def test_windows_line_endings(self):
+        self.assertEqual(self.spans("a\r\nb", "a\r\nc"),
+                         [([(0, 'a')], [(0, 'a')]),
+                          ([(-1, 'b')], [(1, 'c')])])
+
+    def test_offsets_into_texts(self):
+        opcodes = side_by_side_diff("ab\ncd", "ab\nxcd").opcodes()
+
+        self.assertEqual(opcodes.line_spans(1),
+                         [[(0, 3, 5)], [(1, 3, 4), (0, 4, 6)]])
+        self.assertEqual(list(opcodes.changed), [0, 1])
+
+    def test_opcodes_match_html_lines(self):
+        rnd = random.Random(0)
+        for _ in range(200):
+            old_text = ''.join(rnd.choice('ab<\r\n') for _ in range(20))
+            new_text = ''.join(rnd.choice('ab<\r\n') for _ in range(20))
+            diff = side_by_side_diff(old_text, new_text)
+            opcodes = diff.opcodes()
+
+            self.assertEqual(list(opcodes.html_lines(old_text, new_text)),
+                             list(diff))
+            self.assertEqual([bool(changed) for changed in opcodes.changed],
+                             [left != right for left, right in diff])
+
+    def test_compact_context_diff_matches_context_diff(self):
+        rnd = random.Random(0)
+        for _ in range(100):
+            old_text = '\n'.join(rnd.choice(['a', 'b', '', 'c d'])
+                                  for _ in range(30))
+            new_text = '\n'.join(rnd.choice(['a', 'b', '', 'c e'])
+                                  for _ in range(30))
+            diff = side_by_side_diff(old_text, new_text)
+            for context in range(4):
+                opcodes, ranges = compact_context_diff(diff, context)
+
+                self.assertEqual(list(context_hunks(opcodes, ranges,
+                                                    old_text, new_text)),
+                                 list(context_diff(diff, context)))
+
+
+@unittest.skipUnless(can_test_diff, "Diff match patch library not installed")
+class DiffBudgetTest(unittest.TestCase):
+    def test_diff_within_budget_is_not_degraded(self):
+        diff = side_by_side_diff("old text\nline", "new text\nline",
+                                 max_size=100)
+
+        self.assertFalse(diff.degraded)
+        self.assertEqual(list(diff),
+                         [("<del>old</del> text", "<ins>new</ins> text"),
+                          ("line", "line")])
+
+    def test_diff_exceeding_size_is_degraded_to_lines(self):
+        diff = side_by_side_diff("old text\nline", "new text\nline",
+                                 max_size=10)
+
+        self.assertTrue(diff.degraded)
+        self.assertEqual(list(diff),
+                         [("<del>old text</del>", "<ins>new text</ins>"),
+                          ("line", "line")])
+
+    def test_diff_exceeding_time_is_degraded_to_lines(self):
+        lines = [("line %d" % i) for i in range(100)]
+        changed_lines = list(lines)
+        changed_lines[10] = 'line ten'
+
+        diff = side_by_side_diff('\n'.join(lines), '\n'.join(changed_lines),
+                                 line_mode=True, timeout=1e-9)
+
+        self.assertTrue(diff.degraded)
+        self.assertEqual(list(diff)[10], ("<del>line 10</del>",
+                                          "<ins>line ten</ins>"))
+
+    def test_character_diff_exceeding_time_is_degraded_to_lines(self):
+        diff = side_by_side_diff("old text\nline", "new text\nline",
+                                 line_mode=False, timeout=1e-9)
+
+        self.assertTrue(diff.degraded)
+        self.assertEqual(list(diff),
+                         [("<del>old text</del>", "<ins>new text</ins>"),
+                          ("line", "line")])
+
+    def test_diff_without_time_limit(self):
+        diff = side_by_side_diff("old text", "new text", timeout=0)
+
+        self.assertFalse(diff.degraded)
+        self.assertEqual(list(diff),
+                         [("<del>old</del> text", "<ins>new</ins> text")])
+
+    def test_line_mode_diff_without_time_limit(self):
+        lines = [("line %d" % i) for i in range(100)]
+        changed_lines = list(lines)
+        changed_lines[10] = 'line ten'
+
+        diff = side_by_side_diff('\n'.join(lines), '\n'.join(changed_lines),
+                                 line_mode=True, timeout=0)
+
+        self.assertFalse(diff.degraded)
+        self.assertEqual(list(diff)[10], ("line <del>10</del>",
+                                          "line <ins>ten</ins>"))
+
+
 @unittest.skipUnless(can_test_diff, "Diff match patch library not installed")
 class ContextDiffTest(unittest.TestCase):
     def test_small_change_is_included(self):
@@ -257,3 +453,283 @@ class ContextDiffTest(unittest.TestCase):
 
         self.assertEqual(list(context_diff(diff, context=4)),
                          [(1, 1, list(diff_clone)[1:11])])
+
+
+class FakeRevision(object):
+    def __init__(self, date_created):
+        self.date_created = date_created
+
+
+class FakeVersion(object):
+    def __init__(self, id, date_created=datetime.datetime(2012, 6, 1, 12, 0)):
+        self.id = id
+        self.revision = FakeRevision(date_created)
+
+
+@unittest.skipUnless(can_test_diff, "Diff match patch library not installed")
+@override_settings(WIKIFY_DIFF_CACHE='default')
+class DiffCacheTest(TestCase):
+    def setUp(self):
+        cache.clear()
+
+    def test_cache_key_includes_versions_field_and_context(self):
+        self.assertEqual(diff_cache_key(FakeVersion(1), FakeVersion(2),
+                                        'content', 3),
+                         'wikify:diffops:1:2:20120601120000000000:content:3')
+
+    def test_cache_key_for_first_version(self):
+        self.assertEqual(diff_cache_key(None, FakeVersion(2), 'content'),
+                         'wikify:diffops:0:2:20120601120000000000:content:2')
+
+    def test_cache_key_tells_apart_versions_with_same_id(self):
+        # E.g. a coalesced save replacing the latest version
+        replaced = FakeVersion(2, datetime.datetime(2012, 6, 1, 12, 5))
+        self.assertNotEqual(diff_cache_key(FakeVersion(1), FakeVersion(2),
+                                           'content'),
+                            diff_cache_key(FakeVersion(1), replaced,
+                                           'content'))
+
+    def test_diff_is_stored_in_cache(self):
+        key = diff_cache_key(FakeVersion(1), FakeVersion(2), 'content')
+        hunks, degraded = cached_context_diff("old text", "new text", key=key)
+
+        self.assertEqual(list(hunks),
+                         [(0, 0, [("<del>old</del> text",
+                                   "<ins>new</ins> text")])])
+        self.assertFalse(degraded)
+        opcodes, ranges, degraded = cache.get(key)
+        self.assertEqual(ranges, [(0, 0, 0, 1)])
+        self.assertFalse(degraded)
+
+    def test_diff_is_read_from_cache(self):
+        key = diff_cache_key(FakeVersion(1), FakeVersion(2), 'content')
+        cached_context_diff("old text", "new text", key=key)
+
+        # Would be degraded if calculated again
+        with override_settings(WIKIFY_DIFF_MAX_SIZE=1):
+            hunks, degraded = cached_context_diff("old text", "new text",
+                                                  key=key)
+        self.assertFalse(degraded)
+        self.assertEqual(list(hunks),
+                         [(0, 0, [("<del>old</del> text",
+                                   "<ins>new</ins> text")])])
+
+    def test_spans_share_the_cached_diff(self):
+        key = diff_cache_key(FakeVersion(1), FakeVersion(2), 'content')
+        cached_context_diff("old text", "new text", key=key)
+
+        hunks, _ = cached_context_diff("old text", "new text", key=key,
+                                       spans=True)
+        self.assertEqual(list(hunks), [(0, 0, [([(-1, 'old'), (0, ' text')],
+                                                [(1, 'new'), (0, ' text')])])])
+
+    def test_diff_without_key_is_not_cached(self):
+        hunks, _ = cached_context_diff("old text", "new text")
+
+        self.assertEqual(len(list(hunks)), 1)
+        self.assertEqual(cache.get(diff_cache_key(None, FakeVersion(None),
+                                                  'None')), None)
+
+    @override_settings(WIKIFY_DIFF_CACHE=None)
+    @fudge.patch('wikify.cache.calculate_context_diff')
+    def test_diff_without_cache_is_built_lazily(self, calculate_context_diff):
+        # The compact form is only needed for caching
+        calculate_context_diff.is_callable().times_called(0)
+        key = diff_cache_key(FakeVersion(1), FakeVersion(2), 'content')
+
+        hunks, degraded = cached_context_diff("old text\n" * 10 + "end",
+                                              "new text\n" * 10 + "end",
+                                              context=0, key=key)
+
+        self.assertFalse(isinstance(hunks, list))
+        self.assertEqual(next(iter(hunks)),
+                         (0, 0, [("<del>old</del> text",
+                                  "<ins>new</ins> text")] * 10))
+        self.assertFalse(degraded)
+
+    @override_settings(WIKIFY_DIFF_CACHE_MAX_SIZE=10)
+    def test_large_diff_is_not_cached(self):
+        key = diff_cache_key(FakeVersion(1), FakeVersion(2), 'content')
+        cached_context_diff("old text", "new text", key=key)
+
+        self.assertEqual(cache.get(key), None)
+
+    def test_degraded_diff_is_not_cached(self):
+        key = diff_cache_key(FakeVersion(1), FakeVersion(2), 'content')
+        lines = [("line %d" % i) for i in range(100)]
+        changed_lines = list(lines)
+        changed_lines[10] = 'line ten'
+
+        _, degraded = cached_context_diff('\n'.join(lines),
+                                          '\n'.join(changed_lines),
+                                          key=key, timeout=1e-9)
+
+        self.assertTrue(degraded)
+        self.assertEqual(cache.get(key), None)
+
+    @override_settings(WIKIFY_DIFF_MAX_SIZE=5)
+    def test_budget_is_taken_from_settings(self):
+        hunks, degraded = cached_context_diff("old text", "new text")
+
+        self.assertTrue(degraded)
+        self.assertEqual(list(hunks),
+                         [(0, 0, [("<del>old text</del>",
+                                   "<ins>new text</ins>")])])
+
+    @override_settings(WIKIFY_DIFF_CACHE=None)
+    def test_cache_can_be_disabled(self):
+        key = diff_cache_key(FakeVersion(1), FakeVersion(2), 'content')
+        cached_context_diff("old text", "new text", key=key)
+
+        self.assertEqual(cache.get(key), None)
+
+
+@unittest.skipUnless(can_test_diff, "Diff match patch library not installed")
+@override_settings(WIKIFY_DIFF_CACHE='default',
+                   WIKIFY_DIFF_EXECUTOR='thread',
+                   WIKIFY_DIFF_EXECUTOR_THRESHOLD=10)
+class DiffExecutorTest(TestCase):
+    def setUp(self):
+        cache.clear()
+
+    def test_large_diff_uses_executor(self):
+        self.assertTrue(use_executor("old text", "new text"))
+
+    def test_small_diff_runs_inline(self):
+        self.assertFalse(use_executor("old", "new"))
+
+    @override_settings(WIKIFY_DIFF_EXECUTOR=None)
+    def test_executor_is_off_by_default(self):
+        self.assertFalse(use_executor("old text", "new text"))
+        self.assertEqual(get_pool(), None)
+
+    @override_settings(WIKIFY_DIFF_EXECUTOR='fork')
+    def test_unknown_executor(self):
+        self.assertRaises(ImproperlyConfigured, get_pool)
+
+    def test_diff_in_thread_pool(self):
+        key = diff_cache_key(FakeVersion(1), FakeVersion(2), 'content')
+
+        hunks, degraded = cached_context_diff("old text", "new text", key=key)
+        self.assertEqual(list(hunks), [(0, 0, [("<del>old</del> text",
+                                                "<ins>new</ins> text")])])
+        self.assertFalse(degraded)
+        self.assertNotEqual(cache.get(key), None)
+
+    @override_settings(WIKIFY_DIFF_EXECUTOR='process')
+    def test_diff_in_process_pool(self):
+        hunks, degraded = cached_context_diff("old text", "new text")
+        self.assertEqual(list(hunks), [(0, 0, [("<del>old</del> text",
+                                                "<ins>new</ins> text")])])
+        self.assertFalse(degraded)
+
+    @fudge.patch('wikify.cache.offloaded_context_diff')
+    def test_diff_is_degraded_on_timeout(self, offloaded_context_diff):
+        offloaded_context_diff.expects_call().raises(TimeoutError())
+        key = diff_cache_key(FakeVersion(1), FakeVersion(2), 'content')
+
+        hunks, degraded = cached_context_diff("old text", "new text", key=key)
+        self.assertEqual(list(hunks), [(0, 0, [("<del>old text</del>",
+                                                "<ins>new text</ins>")])])
+        self.assertTrue(degraded)
+        self.assertEqual(cache.get(key), None)
+
+    @override_settings(WIKIFY_DIFF_TIMEOUT=0.5)
+    @fudge.patch('wikify.cache.offloaded_context_diff',
+                 'wikify.diff_utils.line_diff')
+    def test_diff_on_timeout_keeps_to_budget(self, offloaded_context_diff,
+                                             line_diff):
+        offloaded_context_diff.expects_call().raises(TimeoutError())
+        # Without a limit diffing even whole lines can take minutes
+        def check_timeout(dmp, old_text, new_text):
+            self.assertEqual(dmp.Diff_Timeout, 0.5)
+            return [(-1, old_text), (1, new_text)]
+        line_diff.expects_call().calls(check_timeout)
+
+        hunks, degraded = cached_context_diff("old text", "new text")
+        self.assertEqual(len(list(hunks)), 1)
+        self.assertTrue(degraded)
+
+
+@unittest.skipUnless(can_test_diff, "Diff match patch library not installed")
+@override_settings(WIKIFY_DIFF_CACHE='default')
+class WarmDiffCacheTest(TestCase):
+    def setUp(self):
+        cache.clear()
+
+    def warm(self, *args, **options):
+        output = StringIO()
+        options.setdefault('processes', 1)
+        call_command('wikify_warm_diff_cache', *args, stdout=output, **options)
+        return output.getvalue()
+
+    def test_version_pairs(self):
+        date = datetime.datetime(2012, 1, 1)
+        versions = [(1, 1, 'a', date), (2, 1, 'a', date), (3, 1, 'b', date),
+                    (4, 2, 'b', date)]
+
+        self.assertEqual([pair[:3] for pair in version_pairs(versions)],
+                         [(1, None, 1), (1, 1, 2), (1, None, 3), (2, None, 4)])
+
+    def test_diffs_are_stored_in_cache(self):
+        versions = construct_versions(3)
+
+        output = self.warm('wikify.tests.Page')
+
+        self.assertIn("Calculated 3 diffs for 3 versions", output)
+        _, ranges, degraded = cache.get(diff_cache_key(versions[1],
+                                                       versions[2], 'content'))
+        self.assertEqual(ranges, [(0, 0, 0, 1)])
+        self.assertFalse(degraded)
+        self.assertNotEqual(cache.get(diff_cache_key(None, versions[0],
+                                                     'content')), None)
+
+    def test_cached_diffs_are_skipped(self):
+        construct_versions(3)
+        self.warm('wikify.tests.Page')
+
+        self.assertIn("Calculated 0 diffs for 3 versions",
+                      self.warm('wikify.tests.Page'))
+        self.assertIn("Calculated 3 diffs for 3 versions",
+                      self.warm('wikify.tests.Page', force=True))
+
+    def test_filter_by_page(self):
+        versions = construct_versions(2)
+        construct_versions(2)
+
+        output = self.warm('wikify.tests.Page',
+                           pages=[versions[0].object_id])
+
+        self.assertIn("Calculated 2 diffs for 2 versions", output)
+
+    def test_filter_by_date(self):
+        construct_versions(2)
+
+        self.assertIn("for 0 versions",
+                      self.warm('wikify.tests.Page', since='2100-01-01'))
+        self.assertIn("for 2 versions",
+                      self.warm('wikify.tests.Page', until='2100-01-01'))
+
+    @fudge.patch('multiprocessing.Pool')
+    def test_local_memory_cache_is_warmed_in_process(self, Pool):
+        # Worker processes would fill their own local memory cache
+        Pool.is_callable().times_called(0)
+        versions = construct_versions(3)
+        errors = StringIO()
+
+        output = self.warm('wikify.tests.Page', processes=4, batch_size=1,
+                           stderr=errors)
+
+        self.assertIn("using a single process", errors.getvalue())
+        self.assertIn("Calculated 3 diffs for 3 versions", output)
+        self.assertNotEqual(cache.get(diff_cache_key(versions[1],
+                                                     versions[2], 'content')),
+                            None)
+
+    @override_settings(WIKIFY_DIFF_CACHE=None)
+    def test_needs_diff_cache(self):
+        # Django's command execution exits on CommandError
+        errors = StringIO()
+        self.assertRaises(SystemExit, self.warm, 'wikify.tests.Page',
+                          stderr=errors)
+        self.assertIn("No diff cache configured", errors.getvalue())
@@ -0,0 +1,219 @@
+import datetime
+from StringIO import StringIO
+
+from django.utils import unittest
+from django.test import TestCase
+from django.core.management import call_command
+from django.test.utils import override_settings
+from django.utils import timezone
+import reversion
+from reversion import models
+
+from wikify.models import VersionMeta, VersionStats
+from wikify.retention import prunable_versions
+from wikify.tests.view_tests import Page, construct_anonymous_versions
+
+try:
+    import diff_match_patch
+    from wikify import storage
+    from wikify.stats import iter_missing_version_stats
+except ImportError:
+    can_test_diff = False
+else:
+    can_test_diff = True
+
+# Helper
+
+NOW = timezone.make_aware(datetime.datetime(2012, 6, 1, 12, 0), timezone.utc)
+
+def ago(days=0, hours=0, minutes=0):
+    return NOW - datetime.timedelta(days=days, hours=hours, minutes=minutes)
+
+def prune(versions, keep_all=30, keep_hourly=None, keep_daily=None):
+    return sorted(prunable_versions(
+                       versions, NOW, datetime.timedelta(days=keep_all),
+                       keep_hourly and datetime.timedelta(days=keep_hourly),
+                       keep_daily and datetime.timedelta(days=keep_daily)))
+
+def age_versions(versions, days):
+    """Moves the versions (oldest first) back in time, a minute apart."""
+    for idx, version in enumerate(versions):
+        models.Revision.objects.filter(id=version.revision_id).update(
+                  date_created=ago(days=days, minutes=len(versions) - idx))
+
+# Tests
+
+class PrunableVersionsTest(unittest.TestCase):
+    def test_recent_versions_are_kept(self):
+        self.assertEqual(prune([(3, ago(days=1), ''),
+                                (2, ago(days=2), ''),
+                                (1, ago(days=29), '')]),
+                         [])
+
+    def test_old_versions_are_kept_daily(self):
+        self.assertEqual(prune([(4, ago(days=31), ''),
+                                (3, ago(days=31, hours=1), ''),
+                                (2, ago(days=32), ''),
+                                (1, ago(days=32, hours=1), '')]),
+                         [1, 3])
+
+    def test_old_versions_are_kept_hourly(self):
+        self.assertEqual(prune([(5, ago(days=31, minutes=1), ''),
+                                (4, ago(days=31, minutes=2), ''),
+                                (3, ago(days=31, hours=2), ''),
+                                (2, ago(days=41), ''),
+                                (1, ago(days=41, hours=2), '')],
+                               keep_hourly=40),
+                         [1, 4])
+
+    def test_oldest_versions_are_deleted(self):
+        self.assertEqual(prune([(3, ago(days=31), ''),
+                                (2, ago(days=60), ''),
+                                (1, ago(days=70), '')],
+                               keep_daily=50),
+                         [1, 2])
+
+    def test_commented_versions_are_kept(self):
+        self.assertEqual(prune([(3, ago(days=31), ''),
+                                (2, ago(days=31, minutes=1), 'Fix'),
+                                (1, ago(days=31, minutes=2), '')]),
+                         [1])
+
+    def test_latest_version_is_kept(self):
+        self.assertEqual(prune([(2, ago(days=60), ''),
+                                (1, ago(days=60, minutes=1), '')],
+                               keep_daily=50),
+                         [1])
+
+
+class PruneHistoryCommandTest(TestCase):
+
+    urls = 'wikify.tests'
+
+    def test_dry_run(self):
+        versions = list(construct_anonymous_versions(5))
+        age_versions(versions, 40)
+
+        stdout = StringIO()
+        call_command('wikify_prune_history', 'wikify.tests.Page',
+                     dry_run=True, stdout=stdout)
+
+        self.assertEqual(stdout.getvalue(), "Would delete 4 of 5 versions\n")
+        self.assertEqual(reversion.get_for_object_reference(
+                                          Page, versions[0].object_id).count(),
+                         5)
+
+    def test_prune_history(self):
+        versions = list(construct_anonymous_versions(5))
+        age_versions(versions[:4], 40)
+        models.Revision.objects.filter(id=versions[1].revision_id).update(
+                                                             comment='Keep me')
+
+        stdout = StringIO()
+        call_command('wikify_prune_history', 'wikify.tests.Page',
+                     batch_size=1, stdout=stdout)
+
+        self.assertEqual(stdout.getvalue(), "Deleted 2 of 5 versions\n")
+        self.assertEqual(list(reversion.get_for_object_reference(
+                                                  Page, versions[0].object_id)
+                                       .order_by('id')),
+                         [versions[1], versions[3], versions[4]])
+        # Metadata of the deleted revisions is gone, too
+        self.assertEqual(VersionMeta.objects.filter(
+                                    revision__in=[versions[0].revision_id,
+                                                  versions[2].revision_id])
+                                            .count(),
+                         0)
+        self.assertEqual(models.Revision.objects.filter(
+                                      id__in=[version.revision_id
+                                              for version in versions])
+                                                .count(),
+                         3)
+
+    @unittest.skipUnless(can_test_diff,
+                         "Diff match patch library not installed")
+    def test_prune_delta_base(self):
+        versions = list(construct_anonymous_versions(4))
+        for previous, version in zip(versions, versions[1:]):
+            version.serialized_data = storage.encode_delta(
+                                            previous.id, 1,
+                                            storage.version_data(previous),
+                                            storage.version_data(version))
+            version.save()
+        age_versions(versions[:3], 40)
+
+        call_command('wikify_prune_history', 'wikify.tests.Page',
+                     stdout=StringIO())
+
+        kept = list(reversion.get_for_object_reference(Page,
+                                                       versions[0].object_id)
+                             .order_by('id'))
+        self.assertEqual(kept, [versions[2], versions[3]])
+        self.assertEqual([storage.version_object(version).content
+                          for version in kept],
+                         ['content_2', 'content_3'])
+
+    @unittest.skipUnless(can_test_diff,
+                         "Diff match patch library not installed")
+    def test_prune_changes_etag_of_following_diff(self):
+        versions = list(construct_anonymous_versions(4))
+        age_versions(versions[:3], 40)
+        resp = self.client.get('/%s' % versions[2].object_id,
+                               {'action': 'diff',
+                                'version_id': versions[2].id})
+
+        call_command('wikify_prune_history', 'wikify.tests.Page',
+                     stdout=StringIO())
+
+        # Now compared to no version at all
+        new_resp = self.client.get('/%s' % versions[2].object_id,
+                                   {'action': 'diff',
+                                    'version_id': versions[2].id},
+                                   HTTP_IF_NONE_MATCH=resp['ETag'])
+        self.assertEqual(new_resp.status_code, 200)
+        self.assertNotEqual(new_resp['ETag'], resp['ETag'])
+        self.assertEqual(new_resp.context['old_version'], None)
+
+    def test_prune_changes_etag_of_history(self):
+        versions = list(construct_anonymous_versions(5))
+        age_versions(versions[:4], 40)
+        resp = self.client.get('/%s' % versions[0].object_id,
+                               {'action': 'versions'})
+
+        call_command('wikify_prune_history', 'wikify.tests.Page',
+                     stdout=StringIO())
+
+        new_resp = self.client.get('/%s' % versions[0].object_id,
+                                   {'action': 'versions'},
+                                   HTTP_IF_NONE_MATCH=resp['ETag'])
+        self.assertEqual(new_resp.status_code, 200)
+        self.assertNotEqual(new_resp['ETag'], resp['ETag'])
+        self.assertEqual(len(new_resp.context['versions'].object_list), 2)
+
+    @unittest.skipUnless(can_test_diff,
+                         "Diff match patch library not installed")
+    def test_prune_updates_stats_of_following_version(self):
+        versions = list(construct_anonymous_versions(4))
+        for stats in iter_missing_version_stats(versions):
+            stats.save()
+        age_versions(versions[:3], 40)
+
+        call_command('wikify_prune_history', 'wikify.tests.Page',
+                     stdout=StringIO())
+
+        # Now the first version
+        stats = VersionStats.objects.get(version=versions[2])
+        self.assertEqual((stats.lines_added, stats.lines_removed), (1, 0))
+
+    @override_settings(WIKIFY_VERSION_MAX_AGE=3600)
+    def test_prune_reminds_to_purge_shared_caches(self):
+        versions = list(construct_anonymous_versions(4))
+        age_versions(versions[:3], 40)
+
+        stdout = StringIO()
+        call_command('wikify_prune_history', 'wikify.tests.Page',
+                     verbosity=2, stdout=stdout)
+
+        self.assertIn("purge the deleted versions", stdout.getvalue())
+        self.assertIn("Changed diffs of versions: %d\n" % versions[2].id,
+                      stdout.getvalue())
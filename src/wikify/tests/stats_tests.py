@@ -0,0 +1,112 @@
+from StringIO import StringIO
+
+from django.utils import unittest
+from django.test import TestCase
+from django.test.utils import override_settings
+from django.core.management import call_command
+import reversion
+
+from wikify.models import VersionStats
+from wikify.tests.view_tests import Page, construct_versions, get_unique_page_title
+
+try:
+    from wikify.diff_utils import count_lines, line_change_counts
+    from wikify import stats
+except ImportError:
+    can_test_diff = False
+else:
+    can_test_diff = True
+
+# Tests
+
+@unittest.skipUnless(can_test_diff, "Diff match patch library not installed")
+class LineChangeCountsTest(unittest.TestCase):
+    def test_count_lines(self):
+        self.assertEqual(count_lines(''), 0)
+        self.assertEqual(count_lines('a'), 1)
+        self.assertEqual(count_lines('a\n'), 1)
+        self.assertEqual(count_lines('a\nb'), 2)
+
+    def test_changed_line(self):
+        self.assertEqual(line_change_counts('a\nb\nc', 'a\nB\nc'), (1, 1))
+
+    def test_inserted_lines(self):
+        self.assertEqual(line_change_counts('a\nc', 'a\nb1\nb2\nc'), (2, 0))
+
+    def test_removed_lines(self):
+        self.assertEqual(line_change_counts('a\nb\nc', 'a\nc'), (0, 1))
+
+    def test_unchanged_text(self):
+        self.assertEqual(line_change_counts('a\nb', 'a\nb'), (0, 0))
+
+
+@unittest.skipUnless(can_test_diff, "Diff match patch library not installed")
+class VersionStatsTest(TestCase):
+
+    urls = 'wikify.tests'
+
+    def test_stats_of_change(self):
+        old, new = construct_versions(2)
+
+        version_stats = stats.build_version_stats(Page, old, new)
+
+        self.assertEqual(version_stats.lines_added, 1)
+        self.assertEqual(version_stats.lines_removed, 1)
+        self.assertEqual(version_stats.get_changed_fields(), ['content'])
+        self.assertEqual(version_stats.byte_delta, 0)
+
+    def test_stats_of_first_version(self):
+        version = construct_versions(1)[0]
+
+        version_stats = stats.build_version_stats(Page, None, version)
+
+        self.assertEqual(version_stats.lines_added, 1)
+        self.assertEqual(version_stats.lines_removed, 0)
+        self.assertEqual(version_stats.byte_delta, len('content_0'))
+
+    def test_stats_without_change(self):
+        version = construct_versions(1)[0]
+
+        version_stats = stats.build_version_stats(Page, version, version)
+
+        self.assertEqual(version_stats.lines_added, 0)
+        self.assertEqual(version_stats.get_changed_fields(), [])
+
+    @override_settings(WIKIFY_VERSION_STATS=True)
+    def test_edit_view_stores_stats(self):
+        title = get_unique_page_title()
+        self.client.post('/%s' % title, {'action': 'edit',
+                                         'content': 'line 1\nline 2'})
+        self.client.post('/%s' % title, {'action': 'edit',
+                                         'content': 'line 1\nline 2\nline 3'})
+
+        new = reversion.get_for_object_reference(Page, title)[0]
+        self.assertEqual(new.wikify_stats.lines_added, 1)
+        self.assertEqual(new.wikify_stats.lines_removed, 0)
+        self.assertEqual(new.wikify_stats.byte_delta, len('\nline 3'))
+
+    def test_edit_view_stores_no_stats_by_default(self):
+        title = get_unique_page_title()
+        self.client.post('/%s' % title, {'action': 'edit',
+                                         'content': 'line 1'})
+
+        new = reversion.get_for_object_reference(Page, title)[0]
+        self.assertFalse(VersionStats.objects.filter(version=new).exists())
+
+    def test_backfill_command_stores_missing_stats(self):
+        versions = construct_versions(3)
+        other_versions = construct_versions(2)
+        stats.build_version_stats(Page, versions[0], versions[1]).save()
+
+        output = StringIO()
+        call_command('wikify_backfill_stats', batch_size=2, stdout=output)
+
+        self.assertIn("Stored stats for 4 versions", output.getvalue())
+        for version in list(versions) + list(other_versions):
+            self.assertTrue(VersionStats.objects.filter(version=version)
+                                                .exists())
+        # First versions count as all added
+        self.assertEqual(VersionStats.objects.get(version=other_versions[0])
+                                             .lines_added, 1)
+        self.assertEqual(VersionStats.objects.get(version=versions[2])
+                                             .lines_removed, 1)
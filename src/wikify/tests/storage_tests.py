@@ -0,0 +1,285 @@
+from StringIO import StringIO
+
+from django.utils import unittest
+from django.test import TestCase
+from django.test.utils import override_settings
+from django.core.exceptions import ImproperlyConfigured
+from django.core.cache import cache
+import fudge
+from django.core.management import call_command
+import reversion
+
+from wikify.storage import LRUCache, reset_object_caches, version_object
+from wikify.tests.view_tests import (Page, construct_versions,
+                                     get_unique_page_title)
+
+try:
+    import diff_match_patch
+    from wikify import storage
+except ImportError:
+    can_test_diff = False
+else:
+    can_test_diff = True
+
+# Helper
+
+LONG_TEXT = '\n'.join("Line %d of a long page" % idx for idx in range(100))
+
+def long_content(idx):
+    return LONG_TEXT + "\nEdit %d" % idx
+
+def construct_long_versions(version_count):
+    instance = Page(title=get_unique_page_title())
+    for idx in range(version_count):
+        with reversion.revision:
+            instance.content = long_content(idx)
+            instance.save()
+    return instance.pk, list(reversion.get_for_object_reference(Page,
+                                                                instance.pk)
+                                      .order_by('id'))
+
+# Tests
+
+@unittest.skipUnless(can_test_diff, "Diff match patch library not installed")
+class DeltaStorageTest(TestCase):
+
+    urls = 'wikify.tests'
+
+    def test_pack_version(self):
+        _, (old, new) = construct_long_versions(2)
+        full_data = new.serialized_data
+
+        self.assertTrue(storage.pack_version(new, old))
+
+        self.assertTrue(new.serialized_data.startswith(storage.DELTA_PREFIX))
+        self.assertTrue(len(new.serialized_data) < len(full_data) / 10)
+        self.assertEqual(storage.parse_delta(new.serialized_data)[:2],
+                         (old.id, 1))
+
+    def test_version_data_applies_deltas(self):
+        title, versions = construct_long_versions(4)
+        full_data = [version.serialized_data for version in versions]
+        for previous, version in zip(versions, versions[1:]):
+            storage.pack_version(version, previous)
+            version.save()
+
+        # Read from the database again, without the data kept when packing
+        versions = reversion.get_for_object_reference(Page, title).order_by('id')
+        self.assertEqual([storage.version_data(version)
+                          for version in versions],
+                         full_data)
+        self.assertEqual([storage.version_object(version).content
+                          for version in versions],
+                         [long_content(idx) for idx in range(4)])
+
+    @override_settings(WIKIFY_DELTA_KEYFRAME_INTERVAL=3)
+    def test_keyframes(self):
+        title, versions = construct_long_versions(7)
+        for previous, version in zip(versions, versions[1:]):
+            storage.pack_version(version, previous)
+
+        self.assertEqual([storage.get_depth(version.serialized_data)
+                          for version in versions],
+                         [0, 1, 2, 0, 1, 2, 0])
+
+    def test_packed_versions_are_skipped(self):
+        _, (old, new) = construct_long_versions(2)
+        storage.pack_version(new, old)
+
+        self.assertFalse(storage.pack_version(new, old))
+
+    @override_settings(WIKIFY_DELTA_STORAGE=True)
+    def test_edit_view_stores_delta(self):
+        title = get_unique_page_title()
+        for idx in range(3):
+            self.client.post('/%s' % title,
+                             {'action': 'edit',
+                              'content': long_content(idx)})
+        versions = list(reversion.get_for_object_reference(Page, title)
+                                 .order_by('id'))
+        self.assertEqual([storage.get_depth(version.serialized_data)
+                          for version in versions],
+                         [0, 1, 2])
+
+        resp = self.client.get('/%s' % title, {'action': 'version',
+                                               'version_id': versions[1].id})
+        self.assertEqual(resp.context['instance'].content,
+                         long_content(1))
+
+        resp = self.client.get('/%s' % title, {'action': 'edit',
+                                               'version_id': versions[2].id})
+        self.assertEqual(resp.context['form'].instance.content,
+                         long_content(2))
+
+        resp = self.client.get('/%s' % title, {'action': 'diff',
+                                               'version_id': versions[2].id})
+        self.assertEqual([field.name for field, _, _
+                          in resp.context['changed_fields']],
+                         ['content'])
+
+    def test_pack_history_command(self):
+        title, versions = construct_long_versions(5)
+        full_data = [version.serialized_data for version in versions]
+
+        stdout = StringIO()
+        call_command('wikify_pack_history', 'wikify.tests.Page',
+                     batch_size=2, stdout=stdout)
+
+        self.assertIn("Packed 4 of", stdout.getvalue())
+        packed = list(reversion.get_for_object_reference(Page, title)
+                               .order_by('id'))
+        self.assertEqual([storage.get_depth(version.serialized_data)
+                          for version in packed],
+                         [0, 1, 2, 3, 4])
+        self.assertEqual([storage.version_data(version) for version in packed],
+                         full_data)
+
+        call_command('wikify_pack_history', 'wikify.tests.Page',
+                     unpack=True, stdout=StringIO())
+
+        self.assertEqual([version.serialized_data
+                          for version in reversion.get_for_object_reference(
+                                                                   Page, title)
+                                                  .order_by('id')],
+                         full_data)
+
+
+@unittest.skipUnless(can_test_diff, "Diff match patch library not installed")
+class CompressionTest(TestCase):
+
+    urls = 'wikify.tests'
+
+    def test_compress(self):
+        data = u'[{"fields": {"content": "%s \u00e9"}}]' % LONG_TEXT
+        compressed = storage.compress(data, 'zlib', level=9)
+
+        self.assertTrue(compressed.startswith(u'wikify-zlib:'))
+        self.assertTrue(len(compressed) < len(data) / 4)
+        self.assertEqual(storage.decompress(compressed), data)
+
+    def test_uncompressed_data_is_kept(self):
+        self.assertEqual(storage.decompress(u'[{"fields": {}}]'),
+                         u'[{"fields": {}}]')
+
+    @override_settings(WIKIFY_COMPRESSION='zip')
+    def test_unknown_compression(self):
+        self.assertRaises(ImproperlyConfigured, storage.get_compression)
+
+    @override_settings(WIKIFY_COMPRESSION='zlib')
+    def test_edit_view_stores_compressed_version(self):
+        title = get_unique_page_title()
+        self.client.post('/%s' % title, {'action': 'edit',
+                                         'content': long_content(0)})
+        version = reversion.get_for_object_reference(Page, title)[0]
+
+        self.assertTrue(version.serialized_data.startswith(u'wikify-zlib:'))
+        resp = self.client.get('/%s' % title, {'action': 'version',
+                                               'version_id': version.id})
+        self.assertEqual(resp.context['instance'].content, long_content(0))
+
+    @override_settings(WIKIFY_COMPRESSION='zlib', WIKIFY_DELTA_STORAGE=True)
+    def test_edit_view_stores_compressed_delta(self):
+        title = get_unique_page_title()
+        for idx in range(3):
+            self.client.post('/%s' % title, {'action': 'edit',
+                                             'content': long_content(idx)})
+        versions = reversion.get_for_object_reference(Page, title).order_by('id')
+
+        self.assertEqual([storage.get_depth(storage.decompress(
+                                                     version.serialized_data))
+                          for version in versions],
+                         [0, 1, 2])
+        self.assertEqual([storage.version_object(version).content
+                          for version in versions],
+                         [long_content(idx) for idx in range(3)])
+
+    def test_compress_history_command(self):
+        title, versions = construct_long_versions(3)
+        full_data = [version.serialized_data for version in versions]
+
+        stdout = StringIO()
+        with override_settings(WIKIFY_COMPRESSION='zlib'):
+            call_command('wikify_compress_history', 'wikify.tests.Page',
+                         batch_size=2, stdout=stdout)
+
+        self.assertIn("Compressed 3 of 3 versions", stdout.getvalue())
+        compressed = reversion.get_for_object_reference(Page, title)
+        self.assertTrue(all(version.serialized_data.startswith(u'wikify-zlib:')
+                            for version in compressed))
+
+        call_command('wikify_compress_history', 'wikify.tests.Page',
+                     stdout=StringIO())
+
+        self.assertEqual([version.serialized_data
+                          for version in reversion.get_for_object_reference(
+                                                                   Page, title)
+                                                  .order_by('id')],
+                         full_data)
+
+
+class LRUCacheTest(unittest.TestCase):
+    def test_get_and_set(self):
+        lru = LRUCache(2)
+        lru.set('a', 1)
+        self.assertEqual(lru.get('a'), 1)
+        self.assertEqual(lru.get('b'), None)
+
+    def test_least_recently_used_entry_is_dropped(self):
+        lru = LRUCache(2)
+        lru.set('a', 1)
+        lru.set('b', 2)
+        lru.get('a')
+        lru.set('c', 3)
+
+        self.assertEqual(len(lru), 2)
+        self.assertEqual(lru.get('b'), None)
+        self.assertEqual(lru.get('a'), 1)
+        self.assertEqual(lru.get('c'), 3)
+
+
+class ObjectCacheTest(TestCase):
+
+    urls = 'wikify.tests'
+
+    def setUp(self):
+        reset_object_caches()
+
+    def tearDown(self):
+        reset_object_caches()
+
+    def test_versions_are_deserialized_each_time_by_default(self):
+        version = construct_versions(1)[0]
+
+        self.assertFalse(version_object(version) is version_object(version))
+
+    @override_settings(WIKIFY_OBJECT_CACHE_SIZE=10)
+    def test_versions_are_deserialized_once(self):
+        version = construct_versions(1)[0]
+        instance = version_object(version)
+
+        with fudge.patch('wikify.storage.deserialize_version') as deserialize:
+            deserialize.is_callable().times_called(0)
+            self.assertTrue(version_object(version) is instance)
+
+    @override_settings(WIKIFY_OBJECT_CACHE_SIZE=10)
+    def test_changed_data_is_deserialized_again(self):
+        version = construct_versions(1)[0]
+        version_object(version)
+
+        # E.g. a deleted version's id used again
+        version.serialized_data = version.serialized_data.replace('content_0',
+                                                                  'other')
+        version.save()
+        version = reversion.get_for_object_reference(Page,
+                                                     version.object_id)[0]
+        self.assertEqual(version_object(version).content, 'other')
+
+    @override_settings(WIKIFY_OBJECT_CACHE='default')
+    def test_versions_are_read_from_shared_cache(self):
+        cache.clear()
+        version = construct_versions(1)[0]
+        version_object(version)
+
+        with fudge.patch('wikify.storage.deserialize_version') as deserialize:
+            deserialize.is_callable().times_called(0)
+            self.assertEqual(version_object(version).content, 'content_0')
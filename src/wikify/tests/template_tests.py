@@ -6,15 +6,17 @@ import fudge
 from django.utils import unittest
 from django.test.client import RequestFactory
 from django.shortcuts import render
-from django.template import defaultfilters
+from django.template import defaultfilters, Template, Context
 from django.conf import settings
+from django.test.utils import override_settings
 from django.core import paginator
 from django.db import models
 from django.forms.models import modelform_factory
 from django.contrib.auth.models import User
 import reversion
 
-from wikify.models import VersionMeta
+from wikify.models import VersionMeta, VersionStats
+from wikify.pagination import CursorPage
 
 try:
     from wikify.diff_utils import side_by_side_diff, context_diff
@@ -299,6 +301,22 @@ class VersionsTemplateTest(TemplateTestMixin, unittest.TestCase):
                               ".wikify-comment:contains('%s')"
                               % versions[0].revision.comment)
 
+    def test_versions_template_has_change_stats(self):
+        versions = construct_versions(1)
+        VersionStats.objects.create(version=versions[0], lines_added=12,
+                                    lines_removed=3)
+        request, context = self._prepare_request(versions=versions)
+        response = render(request, self.template, context)
+
+        self.assertHasElement(response, ".wikify-changes .wikify-added:contains('+12')")
+        self.assertHasElement(response, ".wikify-changes .wikify-removed:contains('3')")
+
+    def test_versions_template_has_no_change_stats_by_default(self):
+        versions = construct_versions(1)
+        request, context = self._prepare_request(versions=versions)
+        response = render(request, self.template, context)
+
+        self.assertHasNoElement(response, ".wikify-changes")
 
     def test_versions_template_has_page_count(self):
         versions = construct_versions(30)
@@ -343,6 +361,32 @@ class VersionsTemplateTest(TemplateTestMixin, unittest.TestCase):
                                 "a:contains('previous')")
 
 
+    def test_versions_template_links_to_older_versions_by_id(self):
+        versions = construct_versions(3)
+        request, context = self._prepare_request(versions=versions)
+        context['versions'] = CursorPage(list(versions),
+                                         next_before=versions[0].id)
+        response = render(request, self.template, context)
+
+        self.assertHasElement(response,
+                              "a[href$='before=%d']:contains('next')"
+                              % versions[0].id)
+        self.assertHasNoElement(response, "a:contains('previous')")
+        self.assertHasNoElement(response, ".wikify-current")
+
+    def test_versions_template_links_to_newer_versions_by_id(self):
+        versions = construct_versions(3)
+        request, context = self._prepare_request(versions=versions)
+        context['versions'] = CursorPage(list(versions),
+                                         previous_after=versions[2].id)
+        response = render(request, self.template, context)
+
+        self.assertHasElement(response,
+                              "a[href$='after=%d']:contains('previous')"
+                              % versions[2].id)
+        self.assertHasNoElement(response, "a:contains('next')")
+
+
 @unittest.skipUnless(can_test_diff, "Diff match patch library not installed")
 class DiffTemplateTest(TemplateTestMixin, unittest.TestCase):
     def setUp(self):
@@ -363,12 +407,14 @@ class DiffTemplateTest(TemplateTestMixin, unittest.TestCase):
         # https://bitbucket.org/kumar303/fudge/issue/15/callable-fudgefake-returns-true-even
         fake_content_field.is_callable().returns(fake_content_field)
 
+        fields = [(fake_content_field,
+                   old_version.object_version.object.content
+                       if old_version else None,
+                   new_version.object_version.object.content)]
         context = {'old_version': old_version,
                    'new_version': new_version,
-                   'fields': [(fake_content_field,
-                               old_version.object_version.object.content
-                                   if old_version else None,
-                               new_version.object_version.object.content)],
+                   'fields': fields,
+                   'changed_fields': fields,
                    'next_version': next_version}
         return request, context
 
@@ -393,6 +439,39 @@ class DiffTemplateTest(TemplateTestMixin, unittest.TestCase):
                               ".wikify-content ins:contains('%s')"
                               % '123456')
 
+    @override_settings(WIKIFY_DIFF_MAX_SIZE=1)
+    def test_diff_template_shows_notice_for_degraded_diff(self):
+        old_version, new_version = construct_versions(2)
+        request, context = self._prepare_request(old_version, new_version)
+        response = render(request, self.template, context)
+
+        self.assertHasElement(response, ".wikify-degraded")
+
+    def test_diff_template_has_no_notice_for_detailed_diff(self):
+        old_version, new_version = construct_versions(2)
+        request, context = self._prepare_request(old_version, new_version)
+        response = render(request, self.template, context)
+
+        self.assertHasNoElement(response, ".wikify-degraded")
+
+    def test_diff_template_has_no_rows_for_unchanged_field(self):
+        old_version, new_version = construct_versions(2)
+        request, context = self._prepare_request(old_version, new_version)
+        field, _, new_value = context['fields'][0]
+        context['fields'] = context['changed_fields'] = [(field, new_value,
+                                                          new_value)]
+        response = render(request, self.template, context)
+
+        self.assertHasNoElement(response, ".wikify-content tbody tr")
+
+    def test_diff_template_shows_changed_fields_only(self):
+        old_version, new_version = construct_versions(2)
+        request, context = self._prepare_request(old_version, new_version)
+        context['changed_fields'] = []
+        response = render(request, self.template, context)
+
+        self.assertHasNoElement(response, ".wikify-content del")
+
     def test_diff_template_has_change_date(self):
         old_version, new_version = construct_versions(2)
         request, context = self._prepare_request(old_version, new_version)
@@ -520,3 +599,56 @@ class DiffTemplateTest(TemplateTestMixin, unittest.TestCase):
 
         self.assertHasNoElement(response,
                                 "a:contains('previous')")
+
+
+@unittest.skipUnless(can_test_diff, "Diff match patch library not installed")
+class ContextDiffRowsTest(unittest.TestCase):
+    OLD_TEXT = "first\nsecond line\nthird\n\nfifth\nsixth <b>"
+    NEW_TEXT = "first\nsecond row\nthird\n\nfifth\nsixth <b>\nseventh"
+
+    def render_rows(self, **settings):
+        template = Template("{% load diff %}<table>"
+                            "{% context_diff_tr old_text new_text 1 %}"
+                            "</table>")
+        with override_settings(**settings):
+            content = template.render(Context({'old_text': self.OLD_TEXT,
+                                               'new_text': self.NEW_TEXT}))
+        doc = html.fromstring(content)
+        return [(row.get('class'),
+                 [(cell.get('class'), cell.get('colspan'),
+                   html.tostring(cell).split('>', 1)[1].rsplit('<', 1)[0]
+                                      .strip())
+                  for cell in row.findall('td')])
+                for row in doc.findall('.//tr')]
+
+    def test_rows_match_template(self):
+        rows = self.render_rows()
+
+        self.assertEqual(len(rows), 7)
+        self.assertEqual(rows, self.render_rows(
+                     WIKIFY_DIFF_ROWS_TEMPLATE='wikify/contextual_diff_tr.html'))
+
+    def test_degraded_rows_match_template(self):
+        rows = self.render_rows(WIKIFY_DIFF_MAX_SIZE=1)
+
+        self.assertEqual(rows[0][0], 'wikify-degraded')
+        self.assertEqual(rows, self.render_rows(
+                     WIKIFY_DIFF_MAX_SIZE=1,
+                     WIKIFY_DIFF_ROWS_TEMPLATE='wikify/contextual_diff_tr.html'))
+
+    def test_tag_can_end_template(self):
+        template = Template("{% load diff %}"
+                            "{% context_diff_tr old_text new_text 1 %}")
+        content = template.render(Context({'old_text': self.OLD_TEXT,
+                                           'new_text': self.NEW_TEXT}))
+
+        self.assertIn('second <ins>row</ins>', content)
+
+    def test_tag_keeps_following_content(self):
+        template = Template("{% load diff %}<table>"
+                            "{% context_diff_tr old_text new_text 1 %}"
+                            "</table>")
+        content = template.render(Context({'old_text': self.OLD_TEXT,
+                                           'new_text': self.NEW_TEXT}))
+
+        self.assertTrue(content.endswith('</table>'))
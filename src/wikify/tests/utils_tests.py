@@ -0,0 +1,135 @@
+from django.utils import unittest
+from django.test import TestCase
+from django.db.models.signals import class_prepared
+import reversion
+
+from wikify import utils
+from wikify.tests.view_tests import Page, construct_versions
+
+# Tests
+
+class ModelWikiFormTest(unittest.TestCase):
+    def setUp(self):
+        utils.clear_model_wiki_forms()
+
+    def test_wiki_form_excludes_primary_key(self):
+        form_class = utils.get_model_wiki_form(Page)
+
+        self.assertEqual(sorted(form_class.base_fields.keys()),
+                         ['content', 'wikify_comment'])
+
+    def test_wiki_form_is_built_once(self):
+        self.assertTrue(utils.get_model_wiki_form(Page)
+                        is utils.get_model_wiki_form(Page))
+
+    def test_wiki_form_is_rebuilt_after_clearing(self):
+        form_class = utils.get_model_wiki_form(Page)
+        utils.clear_model_wiki_forms(Page)
+
+        self.assertFalse(form_class is utils.get_model_wiki_form(Page))
+
+    def test_wiki_form_is_rebuilt_for_reloaded_model(self):
+        form_class = utils.get_model_wiki_form(Page)
+
+        class_prepared.send(sender=Page)
+
+        self.assertFalse(form_class is utils.get_model_wiki_form(Page))
+
+
+class VersionFieldsTest(TestCase):
+    def test_fields_exclude_primary_key(self):
+        old, new = construct_versions(2)
+        fields = utils.VersionFields(Page, old, new)
+
+        self.assertEqual([field.name for field, _, _ in fields], ['content'])
+
+    def test_length_does_not_deserialize_versions(self):
+        old, new = construct_versions(2)
+        fields = utils.VersionFields(Page, old, new)
+
+        self.assertEqual(len(fields), 1)
+        self.assertEqual(fields._objects, {})
+
+    def test_values_by_index(self):
+        old, new = construct_versions(2)
+        field, old_value, new_value = utils.VersionFields(Page, old, new)[0]
+
+        self.assertEqual(field.name, 'content')
+        self.assertEqual(old_value, 'content_0')
+        self.assertEqual(new_value, 'content_1')
+
+    def test_first_version_has_no_old_values(self):
+        new = construct_versions(1)[0]
+        _, old_value, new_value = utils.VersionFields(Page, None, new)[0]
+
+        self.assertEqual(old_value, None)
+        self.assertEqual(new_value, 'content_0')
+
+    def test_changed_fields(self):
+        old, new = construct_versions(2)
+        fields = utils.VersionFields(Page, old, new)
+
+        self.assertEqual(fields.get_changed_fields(),
+                         [Page._meta.get_field('content')])
+        self.assertEqual(fields._objects, {})
+
+    def test_unchanged_fields(self):
+        version = construct_versions(1)[0]
+        fields = utils.VersionFields(Page, version, version)
+
+        self.assertEqual(fields.get_changed_fields(), [])
+        self.assertEqual(list(fields.changed()), [])
+        self.assertEqual(fields._objects, {})
+
+    def test_changed_fields_of_first_version(self):
+        new = construct_versions(1)[0]
+        changed = utils.VersionFields(Page, None, new).changed()
+
+        self.assertEqual(list(changed),
+                         [(Page._meta.get_field('content'), None,
+                           'content_0')])
+
+    def test_model_fields(self):
+        instance = Page(title='title', content='content')
+
+        self.assertEqual(list(utils.ModelFields(instance)),
+                         [(Page._meta.get_field('content'), 'content')])
+
+
+class VersionWithNeighboursTest(TestCase):
+    def test_version_in_the_middle(self):
+        versions = construct_versions(5)
+        previous, version, next = versions[1:4]
+
+        self.assertEqual(utils.get_version_with_neighbours(versions,
+                                                           version.id),
+                         (previous, version, next))
+
+    def test_first_version(self):
+        versions = construct_versions(2)
+
+        self.assertEqual(utils.get_version_with_neighbours(versions,
+                                                           versions[0].id),
+                         (None, versions[0], versions[1]))
+
+    def test_last_version(self):
+        versions = construct_versions(2)
+
+        self.assertEqual(utils.get_version_with_neighbours(versions,
+                                                           versions[1].id),
+                         (versions[0], versions[1], None))
+
+    def test_version_of_other_instance(self):
+        versions = construct_versions(2)
+        other_versions = construct_versions(2)
+
+        self.assertRaises(reversion.models.Version.DoesNotExist,
+                          utils.get_version_with_neighbours,
+                          versions, other_versions[0].id)
+
+    def test_neighbours_are_found_with_bounded_queries(self):
+        versions = construct_versions(30)
+        version_id = versions[15].id
+
+        with self.assertNumQueries(2):
+            utils.get_version_with_neighbours(versions, version_id)
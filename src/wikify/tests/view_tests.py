@@ -1,14 +1,21 @@
 from urllib2 import urlparse
+import datetime
+import json
 import fudge
 
 from django.utils import unittest
 from django.test import TestCase
+from django.test.client import RequestFactory
+from django.test.utils import override_settings
+from django.core.cache import cache
 from django.db import models
 from django.http import HttpResponse
 from django.conf.urls import patterns
+from django.core import serializers
 import reversion
 
 from wikify import wikify
+from wikify.models import VersionMeta
 
 try:
     from wikify.diff_utils import side_by_side_diff, context_diff
@@ -16,6 +23,7 @@ except ImportError:
     can_test_diff = False
 else:
     can_test_diff = True
+    from wikify.cache import diff_cache_key
 
 # App environment
 
@@ -75,8 +83,63 @@ def construct_versions(version_count):
 
     return reversion.get_for_object_reference(Page, instance.pk).order_by("pk")
 
+def construct_anonymous_versions(version_count):
+    assert version_count > 0
+
+    instance = Page(title=get_unique_page_title())
+    for i in range(version_count):
+        with reversion.revision:
+            instance.content = "content_%s" % i
+            instance.save()
+            reversion.revision.add_meta(VersionMeta,
+                                        ip_address='127.0.0.%d' % (i % 256))
+
+    return reversion.get_for_object_reference(Page, instance.pk).order_by("pk")
+
 # Test cases
 
+class WikifyDecoratorTest(TestCase):
+
+    urls = 'wikify.tests'
+
+    def test_wikify_calls_decorated_view_without_action(self):
+        resp = self.client.get('/%s' % get_unique_page_title())
+
+        self.assertEquals(resp.status_code, 200)
+        self.assertEquals(resp.content, "OK")
+
+    @fudge.patch('wikify.resolve_model')
+    def test_wikify_resolves_model_once(self, resolve_model):
+        (resolve_model.expects_call().with_args('wikify.tests.Page')
+                                     .times_called(1)
+                                     .returns(Page))
+
+        view = wikify('wikify.tests.Page')(lambda request, object_id: None)
+        request = RequestFactory().get('/test', {'action': 'versions'})
+        view(request, object_id='test')
+        resp = view(request, object_id='test')
+
+        self.assertEquals(resp.status_code, 200)
+
+    def test_wikify_raises_error_for_missing_module(self):
+        view = wikify('wikify.nonexisting.Page')(lambda request: None)
+        request = RequestFactory().get('/test')
+
+        self.assertRaises(ValueError, view, request)
+
+    def test_wikify_raises_error_for_missing_model(self):
+        view = wikify('wikify.tests.NonExistingPage')(lambda request: None)
+        request = RequestFactory().get('/test')
+
+        self.assertRaises(ValueError, view, request)
+
+    def test_wikify_raises_error_for_invalid_reference(self):
+        view = wikify('Page')(lambda request: None)
+        request = RequestFactory().get('/test')
+
+        self.assertRaises(ValueError, view, request)
+
+
 class EditViewTest(TestCase):
 
     urls = 'wikify.tests'
@@ -191,6 +254,88 @@ class EditViewTest(TestCase):
         self.assertEquals(urlparse.unquote(location),
                           '/%s' % instance.pk)
 
+    def post_edit(self, title, content, comment='', ip_address='127.0.0.1'):
+        return self.client.post('/%s' % title,
+                                {'action': 'edit', 'content': content,
+                                 'wikify_comment': comment},
+                                REMOTE_ADDR=ip_address)
+
+    def test_edit_view_stores_every_save_by_default(self):
+        title = get_unique_page_title()
+        self.post_edit(title, 'first')
+        self.post_edit(title, 'second')
+
+        self.assertEquals(reversion.get_for_object_reference(Page, title)
+                                   .count(),
+                          2)
+
+    @override_settings(WIKIFY_COALESCE_WINDOW=600)
+    def test_edit_view_coalesces_saves_of_same_author(self):
+        title = get_unique_page_title()
+        self.post_edit(title, 'first', comment='Start')
+        self.post_edit(title, 'second')
+        self.post_edit(title, 'third', comment='Fix typo')
+
+        versions = reversion.get_for_object_reference(Page, title)
+        self.assertEquals(len(versions), 1)
+        self.assertEquals(versions[0].object_version.object.content, 'third')
+        self.assertEquals(versions[0].revision.comment, 'Start; Fix typo')
+        self.assertEquals(VersionMeta.objects.filter(
+                                          revision=versions[0].revision)
+                                             .count(),
+                          1)
+        self.assertEquals(VersionMeta.objects.filter(ip_address='127.0.0.1')
+                                             .count(),
+                          1)
+
+    @override_settings(WIKIFY_COALESCE_WINDOW=600)
+    def test_edit_view_keeps_saves_of_other_authors(self):
+        title = get_unique_page_title()
+        self.post_edit(title, 'first', ip_address='127.0.0.1')
+        self.post_edit(title, 'second', ip_address='127.0.0.2')
+
+        self.assertEquals(reversion.get_for_object_reference(Page, title)
+                                   .count(),
+                          2)
+
+    @unittest.skipUnless(can_test_diff,
+                         "Diff match patch library not installed")
+    @override_settings(WIKIFY_COALESCE_WINDOW=600, WIKIFY_DIFF_CACHE='default')
+    def test_edit_view_coalescing_changes_diff(self):
+        cache.clear()
+        title = get_unique_page_title()
+        self.post_edit(title, 'Start', ip_address='127.0.0.2')
+        self.post_edit(title, 'Start, the middle')
+        version = reversion.get_for_object_reference(Page, title).latest('id')
+        resp = self.client.get('/%s' % title, {'action': 'diff',
+                                               'version_id': version.id})
+        self.assertIn('<ins>, the middle</ins>', resp.content)
+
+        # Replaces the latest version, which may get the same id
+        self.post_edit(title, 'Start, the end')
+        version = reversion.get_for_object_reference(Page, title).latest('id')
+        new_resp = self.client.get('/%s' % title,
+                                   {'action': 'diff', 'version_id': version.id},
+                                   HTTP_IF_NONE_MATCH=resp['ETag'])
+
+        self.assertEquals(new_resp.status_code, 200)
+        self.assertNotEquals(new_resp['ETag'], resp['ETag'])
+        self.assertIn('<ins>, the end</ins>', new_resp.content)
+
+    @override_settings(WIKIFY_COALESCE_WINDOW=600)
+    def test_edit_view_keeps_older_saves(self):
+        title = get_unique_page_title()
+        self.post_edit(title, 'first')
+        version = reversion.get_for_object_reference(Page, title)[0]
+        version.revision.date_created -= datetime.timedelta(seconds=601)
+        version.revision.save()
+
+        self.post_edit(title, 'second')
+
+        self.assertEquals(reversion.get_for_object_reference(Page, title)
+                                   .count(),
+                          2)
+
 # TODO
 # test that comment is saved
 # test invalid form
@@ -220,6 +365,83 @@ class VersionViewTest(TestCase):
         _, field_value = resp.context['fields'][0]
         self.assertEquals(instance.content, field_value)
 
+    def test_version_view_as_json(self):
+        version = construct_anonymous_versions(1)[0]
+
+        resp = self.client.get('/%s' % version.object_id,
+                               {'action': 'version', 'version_id': version.id,
+                                'format': 'json'})
+
+        self.assertEquals(resp.status_code, 200)
+        self.assertEquals(resp['Content-Type'], 'application/json')
+        data = json.loads(resp.content)
+        self.assertEquals(data['object_id'], version.object_id)
+        self.assertEquals(data['fields'], {'content': 'content_0'})
+        self.assertEquals(data['version']['id'], version.id)
+        self.assertEquals(data['version']['user'], None)
+        self.assertEquals(data['version']['ip_address'], '127.0.0.0')
+
+    def test_version_view_as_json_from_other_format(self):
+        version = construct_anonymous_versions(1)[0]
+        instance = version.object_version.object
+        version.format = 'xml'
+        version.serialized_data = serializers.serialize('xml', [instance])
+        version.save()
+
+        resp = self.client.get('/%s' % version.object_id,
+                               {'action': 'version', 'version_id': version.id,
+                                'format': 'json'})
+
+        data = json.loads(resp.content)
+        self.assertEquals(data['fields'], {'content': 'content_0'})
+
+    def test_version_view_answers_conditional_get(self):
+        version = construct_versions(1)[0]
+        resp = self.client.get('/%s' % version.object_id,
+                               {'action': 'version', 'version_id': version.id})
+        self.assertEquals(resp.status_code, 200)
+        self.assertIn('Last-Modified', resp)
+
+        # Not modified without looking at the version's data
+        with self.assertNumQueries(1):
+            resp = self.client.get('/%s' % version.object_id,
+                                   {'action': 'version',
+                                    'version_id': version.id},
+                                   HTTP_IF_NONE_MATCH=resp['ETag'])
+        self.assertEquals(resp.status_code, 304)
+
+    def test_version_view_has_etag_per_format(self):
+        version = construct_versions(1)[0]
+        html_resp = self.client.get('/%s' % version.object_id,
+                                    {'action': 'version',
+                                     'version_id': version.id})
+        json_resp = self.client.get('/%s' % version.object_id,
+                                    {'action': 'version',
+                                     'version_id': version.id,
+                                     'format': 'json'})
+        self.assertNotEquals(html_resp['ETag'], json_resp['ETag'])
+
+    @override_settings(WIKIFY_VERSION_MAX_AGE=3600)
+    def test_version_view_is_immutable(self):
+        version = construct_versions(1)[0]
+        resp = self.client.get('/%s' % version.object_id,
+                               {'action': 'version', 'version_id': version.id})
+        self.assertEquals(set(resp['Cache-Control'].split(', ')),
+                          set(['public', 'max-age=3600', 'immutable']))
+
+    @override_settings(WIKIFY_VERSION_MAX_AGE=3600,
+                       WIKIFY_COALESCE_WINDOW=600)
+    def test_latest_version_is_not_immutable_when_coalescing(self):
+        old, new = construct_versions(2)
+        # The latest version can still be replaced by a coalesced save
+        resp = self.client.get('/%s' % new.object_id,
+                               {'action': 'version', 'version_id': new.id})
+        self.assertNotIn('Cache-Control', resp)
+
+        resp = self.client.get('/%s' % old.object_id,
+                               {'action': 'version', 'version_id': old.id})
+        self.assertIn('immutable', resp['Cache-Control'])
+
     def test_version_view_returns_400_for_invalid_version(self):
         resp = self.client.get('/test',
                                {'action': 'version', 'version_id': 'a42'})
@@ -251,6 +473,31 @@ class VersionsViewTest(TestCase):
         self.assertEquals(instance.pk, resp.context['object_id'])
         self.assertEquals(list(versions), list(resp.context['versions'].object_list))
 
+    def test_versions_view_as_json(self):
+        versions = construct_versions(3)
+
+        resp = self.client.get('/%s' % versions[0].object_id,
+                               {'action': 'versions', 'format': 'json'})
+
+        self.assertEquals(resp.status_code, 200)
+        data = json.loads(resp.content)
+        self.assertEquals([version['id'] for version in data['versions']],
+                          [version.id for version in reversed(versions)])
+        self.assertEquals(data['versions'][0]['comment'], 'Version 2')
+        self.assertEquals((data['page'], data['num_pages']), (1, 1))
+
+    @override_settings(WIKIFY_CURSOR_PAGINATION=True)
+    def test_versions_view_as_json_by_cursor(self):
+        versions = construct_versions(25)
+
+        resp = self.client.get('/%s' % versions[0].object_id,
+                               {'action': 'versions', 'format': 'json'})
+
+        data = json.loads(resp.content)
+        self.assertEquals(len(data['versions']), 20)
+        self.assertEquals(data['next_before'], versions[5].id)
+        self.assertEquals(data['previous_after'], None)
+
     def test_versions_view_shows_paged_results(self):
         versions = construct_versions(40)
         versions = versions.reverse()
@@ -277,6 +524,112 @@ class VersionsViewTest(TestCase):
 
         self.assertEquals(list(versions[20:]), list(resp.context['versions'].object_list))
 
+    def test_versions_view_pages_by_version_id(self):
+        versions = construct_versions(45)
+        versions = list(versions.reverse())
+
+        instance = versions[0].object_version.object
+
+        resp = self.client.get('/%s' % instance.pk,
+                               {'action': 'versions',
+                                'before': versions[19].id})
+
+        self.assertEquals(resp.status_code, 200)
+
+        page = resp.context['versions']
+        self.assertEquals(versions[20:40], list(page.object_list))
+        self.assertEquals(versions[39].id, page.next_before)
+        self.assertEquals(versions[20].id, page.previous_after)
+
+    def test_versions_view_pages_back_by_version_id(self):
+        versions = construct_versions(45)
+        versions = list(versions.reverse())
+
+        instance = versions[0].object_version.object
+
+        resp = self.client.get('/%s' % instance.pk,
+                               {'action': 'versions',
+                                'after': versions[40].id})
+
+        self.assertEquals(resp.status_code, 200)
+
+        page = resp.context['versions']
+        self.assertEquals(versions[20:40], list(page.object_list))
+        self.assertTrue(page.has_next())
+        self.assertTrue(page.has_previous())
+
+    def test_versions_view_last_page_by_version_id(self):
+        versions = construct_versions(25)
+        versions = list(versions.reverse())
+
+        instance = versions[0].object_version.object
+
+        resp = self.client.get('/%s' % instance.pk,
+                               {'action': 'versions',
+                                'before': versions[19].id})
+
+        page = resp.context['versions']
+        self.assertEquals(versions[20:], list(page.object_list))
+        self.assertFalse(page.has_next())
+        self.assertTrue(page.has_previous())
+
+    @override_settings(WIKIFY_CURSOR_PAGINATION=True)
+    def test_versions_view_pages_by_version_id_without_counting(self):
+        versions = construct_anonymous_versions(25)
+        instance = versions[0].object_version.object
+
+        # Latest version and count for the ETag, versions with their revision
+        #   and user, and the IP addresses
+        with self.assertNumQueries(3):
+            resp = self.client.get('/%s' % instance.pk,
+                                   {'action': 'versions'})
+
+        page = resp.context['versions']
+        self.assertEquals(list(versions.reverse()[:20]),
+                          list(page.object_list))
+        self.assertFalse(page.has_previous())
+        self.assertTrue(page.has_next())
+
+    def test_versions_view_answers_conditional_get(self):
+        versions = construct_versions(2)
+        resp = self.client.get('/%s' % versions[0].object_id,
+                               {'action': 'versions'})
+        self.assertEquals(resp.status_code, 200)
+        self.assertNotIn('Cache-Control', resp)
+
+        resp = self.client.get('/%s' % versions[0].object_id,
+                               {'action': 'versions'},
+                               HTTP_IF_NONE_MATCH=resp['ETag'])
+        self.assertEquals(resp.status_code, 304)
+
+    def test_versions_view_changes_etag_for_new_version(self):
+        with reversion.revision:
+            instance = Page.objects.create(title=get_unique_page_title(),
+                                           content="test content")
+        resp = self.client.get('/%s' % instance.pk, {'action': 'versions'})
+
+        with reversion.revision:
+            instance.content = "new content"
+            instance.save()
+
+        resp = self.client.get('/%s' % instance.pk, {'action': 'versions'},
+                               HTTP_IF_NONE_MATCH=resp['ETag'])
+        self.assertEquals(resp.status_code, 200)
+
+    def test_versions_view_fetches_authors_in_bulk(self):
+        versions = construct_anonymous_versions(25)
+        instance = versions[0].object_version.object
+
+        # Latest version and count for the ETag, count of the paginator,
+        #   versions with their revision and user, and the IP addresses
+        with self.assertNumQueries(4):
+            resp = self.client.get('/%s' % instance.pk,
+                                   {'action': 'versions'})
+
+        self.assertEquals(resp.status_code, 200)
+        self.assertContains(resp, '127.0.0.24')
+        self.assertContains(resp, '127.0.0.5')
+
 
 @unittest.skipUnless(can_test_diff, "Diff match patch library not installed")
 class DiffViewTest(TestCase):
@@ -305,6 +658,37 @@ class DiffViewTest(TestCase):
         self.assertEquals(old_instance.content, old_value)
         self.assertEquals(new_instance.content, new_value)
 
+    def test_diff_view_reports_changed_fields(self):
+        old, new = construct_versions(2)
+
+        resp = self.client.get('/%s' % new.object_version.object.pk,
+                               {'action': 'diff',
+                                'version_id': str(new.id)})
+
+        self.assertEquals(resp.status_code, 200)
+        self.assertEquals([field.name for field, _, _
+                           in resp.context['changed_fields']],
+                          ['content'])
+
+    def test_diff_view_as_json(self):
+        old, new, next = construct_versions(3)
+
+        resp = self.client.get('/%s' % new.object_id,
+                               {'action': 'diff', 'version_id': str(new.id),
+                                'format': 'json'})
+
+        self.assertEquals(resp.status_code, 200)
+        self.assertEquals(resp['Content-Type'], 'application/json')
+        data = json.loads(resp.content)
+        self.assertEquals(data['old_version']['id'], old.id)
+        self.assertEquals(data['new_version']['comment'], 'Version 1')
+        self.assertEquals(data['next_version_id'], next.id)
+        self.assertEquals(data['fields'],
+                          [{'name': 'content',
+                            'degraded': False,
+                            'hunks': [[0, 0, [[[[0, 'content_'], [-1, '0']],
+                                               [[0, 'content_'], [1, '1']]]]]]}])
+
     def test_diff_view_for_single_version(self):
         with reversion.revision:
             new_instance = Page.objects.create(title=get_unique_page_title(),
@@ -328,6 +712,84 @@ class DiffViewTest(TestCase):
         self.assertEquals(None, old_value)
         self.assertEquals(new_instance.content, new_value)
 
+    @override_settings(WIKIFY_DIFF_CACHE='default')
+    def test_diff_view_stores_diff_in_cache(self):
+        cache.clear()
+        old, new = construct_versions(2)
+
+        resp = self.client.get('/%s' % new.object_version.object.pk,
+                               {'action': 'diff',
+                                'version_id': str(new.id)})
+
+        self.assertEquals(resp.status_code, 200)
+        _, ranges, degraded = cache.get(diff_cache_key(old, new, 'content'))
+        self.assertEquals(ranges, [(0, 0, 0, 1)])
+        self.assertFalse(degraded)
+
+    @override_settings(WIKIFY_STREAM_DIFFS=True)
+    def test_diff_view_streams_rows(self):
+        old, new = construct_versions(2)
+
+        resp = self.client.get('/%s' % new.object_version.object.pk,
+                               {'action': 'diff',
+                                'version_id': str(new.id)})
+
+        self.assertEquals(resp.status_code, 200)
+        content = ''.join(resp)
+        self.assertNotIn('wikify-diff-rows', content)
+        self.assertIn('content_<del>0</del>', content)
+        self.assertIn('content_<ins>1</ins>', content)
+        self.assertTrue(content.index('<tbody>')
+                        < content.index('content_<del>0</del>')
+                        < content.index('</tbody>'))
+
+    def test_diff_view_uses_constant_number_of_queries(self):
+        versions = construct_anonymous_versions(30)
+        version = versions[15]
+
+        # Version, the next and previous one for the ETag, version with
+        #   predecessor, their IP addresses and the next version
+        with self.assertNumQueries(5):
+            resp = self.client.get('/%s' % version.object_version.object.pk,
+                                   {'action': 'diff',
+                                    'version_id': str(version.id)})
+
+        self.assertEquals(resp.status_code, 200)
+        self.assertEquals(versions[14], resp.context['old_version'])
+        self.assertEquals(versions[16], resp.context['next_version'])
+
+    def test_diff_view_answers_conditional_get(self):
+        old, new = construct_versions(2)
+        resp = self.client.get('/%s' % new.object_id,
+                               {'action': 'diff', 'version_id': str(new.id)})
+        self.assertEquals(resp.status_code, 200)
+
+        with self.assertNumQueries(2):
+            resp = self.client.get('/%s' % new.object_id,
+                                   {'action': 'diff',
+                                    'version_id': str(new.id)},
+                                   HTTP_IF_NONE_MATCH=resp['ETag'])
+        self.assertEquals(resp.status_code, 304)
+
+    @override_settings(WIKIFY_VERSION_MAX_AGE=3600)
+    def test_diff_view_changes_with_next_version(self):
+        old, new = construct_versions(2)
+        resp = self.client.get('/%s' % new.object_id,
+                               {'action': 'diff', 'version_id': str(new.id)})
+        # The link to the next version is still missing
+        self.assertNotIn('Cache-Control', resp)
+
+        instance = new.object_version.object
+        with reversion.revision:
+            instance.content = "new content"
+            instance.save()
+
+        resp = self.client.get('/%s' % new.object_id,
+                               {'action': 'diff', 'version_id': str(new.id)},
+                               HTTP_IF_NONE_MATCH=resp['ETag'])
+        self.assertEquals(resp.status_code, 200)
+        self.assertIn('immutable', resp['Cache-Control'])
+
     def test_diff_view_returns_400_for_invalid_version(self):
         resp = self.client.get('/test',
                                {'action': 'diff', 'version_id': 'a42'})
@@ -1,8 +1,47 @@
+import json
+
 from django import forms
+from django.db.models.signals import class_prepared
 from django.forms.models import modelform_factory
 from django.utils.translation import ugettext_lazy
 
+from wikify.storage import version_data, version_object
+
+# Wiki form classes by model, see get_model_wiki_form
+_wiki_form_classes = {}
+
 def get_model_wiki_form(model):
+    """
+    Returns the form for the given model, excluding the primary key.
+
+    The form class is only built once per model.
+    """
+    form_class = _wiki_form_classes.get(model)
+    if form_class is None:
+        form_class = _wiki_form_classes[model] = build_model_wiki_form(model)
+    return form_class
+
+def clear_model_wiki_forms(model=None):
+    """
+    Forgets the form classes built for the given model (or for all models), so
+    that they are rebuilt on next use.
+    """
+    if model is None:
+        _wiki_form_classes.clear()
+    else:
+        # Also drop forms of other model classes of the same name, e.g. an
+        #   earlier definition of a reloaded model
+        for cached_model in _wiki_form_classes.keys():
+            if (cached_model._meta.app_label == model._meta.app_label
+                and cached_model._meta.object_name == model._meta.object_name):
+                _wiki_form_classes.pop(cached_model, None)
+
+def _model_reloaded(sender, **kwargs):
+    clear_model_wiki_forms(sender)
+
+class_prepared.connect(_model_reloaded)
+
+def build_model_wiki_form(model):
     """Creates a form for the given model, excluding the primary key."""
 
     primary_key_field = model._meta.pk.name
@@ -34,10 +73,149 @@ def version_field_iterator(old_version, new_version):
     each field with its old and new value in the order of declaration inside the
     model.
     """
-    old_obj = old_version.object_version.object if old_version else None
-    new_obj = new_version.object_version.object
+    old_obj = version_object(old_version) if old_version else None
+    new_obj = version_object(new_version)
     for field in new_obj._meta.fields:
         if field != new_obj._meta.pk:
             yield (field,
                    getattr(old_obj, field.name, None),
                    getattr(new_obj, field.name))
+
+class FieldSequence(object):
+    """
+    Lazy sequence of a model's fields (excluding the primary key) in the order
+    of declaration inside the model, each given together with its values.
+
+    Supports len() and indexing, so templates can check the number of fields
+    without the values being read. Subclasses provide get_values(field),
+    returning the values of a field as tuple.
+    """
+    def __init__(self, model):
+        self.fields = [field for field in model._meta.fields
+                       if field != model._meta.pk]
+
+    def __len__(self):
+        return len(self.fields)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[idx] for idx in range(*index.indices(len(self)))]
+        field = self.fields[index]
+        return (field, ) + self.get_values(field)
+
+    def __iter__(self):
+        for field in self.fields:
+            yield (field, ) + self.get_values(field)
+
+class ModelFields(FieldSequence):
+    """
+    The instance's fields with their value, like model_field_iterator.
+    """
+    def __init__(self, instance):
+        super(ModelFields, self).__init__(instance)
+        self.instance = instance
+
+    def get_values(self, field):
+        return (getattr(self.instance, field.name), )
+
+def serialized_field_data(version):
+    """
+    Returns the field values of the version as stored by reversion, without
+    deserializing the model instance, or None if the format is not supported.
+    """
+    if version.format != 'json':
+        return None
+    try:
+        return json.loads(version_data(version))[0]['fields']
+    except (ValueError, LookupError, TypeError):
+        return None
+
+class VersionFields(FieldSequence):
+    """
+    The model's fields with their old and new value, like
+    version_field_iterator. A version is only deserialized once a value is
+    read from it.
+
+    changed() gives the fields whose value differs between the two versions,
+    found by comparing the serialized data.
+    """
+    def __init__(self, model, old_version, new_version, fields=None):
+        super(VersionFields, self).__init__(model)
+        if fields is not None:
+            self.fields = fields
+        self.model = model
+        self.old_version = old_version
+        self.new_version = new_version
+        self._objects = {}
+        self._changed = None
+
+    def get_object(self, version):
+        if version is None:
+            return None
+        if version.id not in self._objects:
+            self._objects[version.id] = version_object(version)
+        return self._objects[version.id]
+
+    def get_values(self, field):
+        return (getattr(self.get_object(self.old_version), field.name, None),
+                getattr(self.get_object(self.new_version), field.name))
+
+    def get_changed_fields(self):
+        """Returns the fields with different values in both versions."""
+        if self._changed is None:
+            old_data = (serialized_field_data(self.old_version)
+                        if self.old_version else None)
+            new_data = serialized_field_data(self.new_version)
+            if old_data is None or new_data is None:
+                # Nothing to compare, compare the deserialized values
+                self._changed = [field for field, old_value, new_value in self
+                                 if old_value != new_value]
+            else:
+                missing = object()
+                self._changed = [field for field in self.fields
+                                 if old_data.get(field.name, missing)
+                                    != new_data.get(field.name, missing)]
+        return self._changed
+
+    def changed(self):
+        """
+        Returns the changed fields with their values, sharing deserialized
+        versions with this sequence.
+        """
+        changed = VersionFields(self.model, self.old_version, self.new_version,
+                                fields=self.get_changed_fields())
+        changed._objects = self._objects
+        changed._changed = changed.fields
+        return changed
+
+def date_stamp(date):
+    """
+    Returns the revision date of a version as compact text. Ids of deleted
+    versions may be used again (e.g. for coalesced saves), together with the id
+    this identifies a version.
+    """
+    return date.strftime('%Y%m%d%H%M%S%f')
+
+def get_version_with_neighbours(versions, version_id):
+    """
+    Returns the version with the given id from versions together with the
+    versions right before and after it, as (previous, version, next).
+
+    Previous and next are None at the start and end of the history. Raises
+    DoesNotExist if versions hold no version with the given id. The ordering of
+    versions is replaced, but they must not have been reversed.
+    """
+    # One row for the version and its predecessor each, found by index
+    version_and_previous = list(versions.filter(id__lte=version_id)
+                                        .order_by('-id')[:2])
+    if not version_and_previous or version_and_previous[0].id != version_id:
+        raise versions.model.DoesNotExist("Version %s not found" % version_id)
+    version = version_and_previous[0]
+    previous = version_and_previous[1] if len(version_and_previous) > 1 else None
+
+    following = list(versions.filter(id__gt=version_id)
+                             .order_by('id')
+                             .prefetch_related(None)[:1])
+    next = following[0] if following else None
+
+    return previous, version, next
@@ -1,13 +1,231 @@
+import datetime
+import json
+from functools import wraps
+
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
 from django.shortcuts import render_to_response
-from django.http import HttpResponseBadRequest, HttpResponseRedirect, Http404
+from django.http import HttpResponse, HttpResponseBadRequest, HttpResponseRedirect, Http404
 from django.template import RequestContext
+from django.template.loader import render_to_string
+from django.utils import timezone
+from django.utils.cache import patch_cache_control
+from django.utils.encoding import force_unicode
+from django.views.decorators.http import condition
 from django.db import transaction
+from django.db.models import Count, Max
 from django.core import paginator
+from django.core import serializers
 from reversion import models
 from reversion import revision
 
 from wikify.models import VersionMeta
 from wikify import utils
+from wikify.storage import version_object, encode_latest_version
+from wikify.pagination import cursor_page
+
+try:
+    from django.http import StreamingHttpResponse
+except ImportError:
+    # Django < 1.5 streams any HttpResponse given an iterator
+    StreamingHttpResponse = HttpResponse
+
+# Placeholder for the diff rows of each field in a streamed diff page
+STREAM_ROWS_MARKER = '<!-- wikify-diff-rows -->'
+
+def get_versions(model, object_id):
+    """
+    Returns all versions of the given instance, fetching the author data and
+    change stats shown in the templates (user or IP address) in bulk.
+    """
+    return (models.Version.objects.get_for_object_reference(model, object_id)
+                                  .select_related('revision',
+                                                  'revision__user',
+                                                  'wikify_stats')
+                                  .prefetch_related(
+                                                  'revision__versionmeta_set'))
+
+def wants_json(request):
+    """Returns whether the structured data is requested instead of HTML."""
+    return request.GET.get('format') == 'json'
+
+def json_response(data):
+    return HttpResponse(json.dumps(data, cls=DjangoJSONEncoder,
+                                   separators=(',', ':')),
+                        content_type='application/json')
+
+def version_json(version):
+    """Returns the date, author and comment of a version for JSON output."""
+    if version is None:
+        return None
+    revision = version.revision
+    metas = revision.versionmeta_set.all()
+    return {'id': version.id,
+            'date': revision.date_created,
+            'user': unicode(revision.user) if revision.user else None,
+            'ip_address': metas[0].ip_address if metas else None,
+            'comment': revision.comment}
+
+def etag(request, *parts):
+    """Returns an ETag of the given parts, telling HTML and JSON apart."""
+    if wants_json(request):
+        parts += ('json',)
+    return '-'.join(str(part) for part in parts)
+
+def conditional(validators_func):
+    """
+    Decorates a view to answer conditional GET requests, by the ETag, the last
+    modification date and whether the content never changes as returned by
+    validators_func(request, model, object_id). As these only need the ids and
+    dates of versions, a 304 is returned before any version is deserialized.
+
+    Responses for content that never changes are marked as immutable, if
+    WIKIFY_VERSION_MAX_AGE is set.
+    """
+    def decorator(func):
+        def get_validators(request, model, object_id, *args, **kwargs):
+            # Looked up once for both the ETag and the modification date
+            if not hasattr(request, '_wikify_validators'):
+                request._wikify_validators = validators_func(request, model,
+                                                             object_id)
+            return request._wikify_validators
+
+        conditional_func = condition(
+                    etag_func=lambda *args: get_validators(*args)[0],
+                    last_modified_func=lambda *args: get_validators(*args)[1]
+                    )(func)
+
+        @wraps(func)
+        def inner(request, model, object_id, *args, **kwargs):
+            response = conditional_func(request, model, object_id,
+                                        *args, **kwargs)
+            max_age = getattr(settings, 'WIKIFY_VERSION_MAX_AGE', None)
+            if (max_age is not None and response.status_code in (200, 304)
+                and get_validators(request, model, object_id)[2]):
+                patch_cache_control(response, public=True, max_age=max_age,
+                                    immutable=True)
+            return response
+
+        return inner
+
+    return decorator
+
+def get_version_id(request):
+    try:
+        return int(request.GET.get('version_id'))
+    except (TypeError, ValueError):
+        return None
+
+def version_validators(request, model, object_id):
+    """
+    A version never changes once saved, unless it is the latest one and a
+    coalesced save can still replace it.
+    """
+    version_id = get_version_id(request)
+    if version_id is None:
+        return None, None, False
+    following = list(models.Version.objects.get_for_object_reference(model,
+                                                                     object_id)
+                                           .filter(id__gte=version_id)
+                                           .order_by('id')
+                                           .values_list('id',
+                                                        'revision__date_created'
+                                                        )[:2])
+    if not following or following[0][0] != version_id:
+        return None, None, False
+    date = following[0][1]
+    final = (len(following) > 1
+             or not getattr(settings, 'WIKIFY_COALESCE_WINDOW', None))
+    return (etag(request, 'version', version_id, utils.date_stamp(date)),
+            date, final)
+
+def diff_validators(request, model, object_id):
+    """
+    A diff only changes when the next version is saved, which is linked to
+    from the page, or when the previous version is deleted by pruning.
+    """
+    version_id = get_version_id(request)
+    if version_id is None:
+        return None, None, False
+    versions = models.Version.objects.get_for_object_reference(model,
+                                                               object_id)
+    following = list(versions.filter(id__gte=version_id)
+                             .order_by('id')
+                             .values_list('id', 'revision__date_created')[:2])
+    if not following or following[0][0] != version_id:
+        return None, None, False
+    previous_ids = list(versions.filter(id__lt=version_id)
+                                .order_by('-id')
+                                .values_list('id', flat=True)[:1])
+    # The latest version can be replaced by one with the same id, tell these
+    #   apart by date
+    version_date = following[0][1]
+    next_id, last_modified = following[-1]
+    if next_id == version_id:
+        next_id = None
+    return (etag(request, 'diff', previous_ids[0] if previous_ids else 0,
+                 version_id, utils.date_stamp(version_date),
+                 next_id or 'latest'),
+            last_modified, next_id is not None)
+
+def versions_validators(request, model, object_id):
+    """
+    The list of versions changes with every new version, and when older ones
+    are deleted by pruning.
+    """
+    stats = (models.Version.objects.get_for_object_reference(model, object_id)
+                                   .aggregate(latest_id=Max('id'),
+                                              count=Count('id'),
+                                              last_modified=Max(
+                                                    'revision__date_created')))
+    if stats['latest_id'] is None:
+        return None, None, False
+    last_modified = stats['last_modified']
+    return (etag(request, 'versions', stats['latest_id'], stats['count'],
+                 utils.date_stamp(last_modified)),
+            last_modified, False)
+
+def get_ip_address(request):
+    return request.META.get('HTTP_X_FORWARDED_FOR',
+                            request.META.get('REMOTE_ADDR'))
+
+def get_coalesced_revision(request, model, object_id):
+    """
+    Returns the revision of the latest version of the given instance if a new
+    save replaces it: if it was saved by the same user (or anonymously from
+    the same IP address) within the last WIKIFY_COALESCE_WINDOW seconds.
+    """
+    window = getattr(settings, 'WIKIFY_COALESCE_WINDOW', None)
+    if not window:
+        return None
+    latest = list(get_versions(model, object_id).order_by('-id')[:1])
+    if not latest:
+        return None
+    latest_revision = latest[0].revision
+
+    if (latest_revision.date_created
+        < timezone.now() - datetime.timedelta(seconds=window)):
+        return None
+    if request.user.is_anonymous():
+        metas = latest_revision.versionmeta_set.all()
+        if (latest_revision.user_id is not None or not metas
+            or metas[0].ip_address != get_ip_address(request)):
+            return None
+    elif latest_revision.user_id != request.user.id:
+        return None
+
+    # Don't lose versions of other objects saved together
+    if latest_revision.version_set.count() != 1:
+        return None
+    return latest_revision
+
+def merge_comments(old_comment, new_comment):
+    """Returns the comment of two coalesced revisions."""
+    if not old_comment or old_comment == new_comment:
+        return new_comment
+    if not new_comment:
+        return old_comment
+    return u'%s; %s' % (old_comment, new_comment)
 
 @transaction.commit_on_success
 def edit(request, model, object_id):
@@ -25,25 +243,43 @@ def edit(request, model, object_id):
         form = form_class(request.POST, instance=page)
 
         if form.is_valid():
+            comment = form.cleaned_data.get('wikify_comment')
+
+            # Replace a revision saved by the same author shortly before,
+            #   deleted first so that the new version is based on the one
+            #   before (e.g. for its stats and delta)
+            coalesced_revision = get_coalesced_revision(request, model,
+                                                        object_id)
+            if coalesced_revision is not None:
+                comment = merge_comments(coalesced_revision.comment, comment)
+                coalesced_revision.delete()
+
             with revision:
                 # Save the author, use our metadata model if user is anonymous
                 if not request.user.is_anonymous():
                     revision.user = request.user
                 else:
-                    ip_address = request.META.get('HTTP_X_FORWARDED_FOR',
-                                                request.META.get('REMOTE_ADDR'))
+                    ip_address = get_ip_address(request)
                     if ip_address:
                         revision.add_meta(VersionMeta,
                                           ip_address=ip_address)
 
                 # Save a comment for the revision
-                if form.cleaned_data.get('wikify_comment'):
-                    revision.comment = form.cleaned_data['wikify_comment']
+                if comment:
+                    revision.comment = comment
 
                 form.save()
 
-                # Successfully saved the page, now return to the 'read' view
-                return HttpResponseRedirect(request.path)
+            if getattr(settings, 'WIKIFY_VERSION_STATS', False):
+                # Needs diff_match_patch, only import when used
+                from wikify.stats import save_latest_version_stats
+                save_latest_version_stats(model, object_id)
+
+            # Store as delta and compressed, if configured
+            encode_latest_version(model, object_id)
+
+            # Successfully saved the page, now return to the 'read' view
+            return HttpResponseRedirect(request.path)
     else:
         if request.GET.get('version_id'):
             # User is editing the page based on an older version
@@ -52,7 +288,7 @@ def edit(request, model, object_id):
                 version = (models.Version.objects.get_for_object_reference(
                                                                model, object_id)
                                          .get(id=version_id))
-                page = version.object_version.object
+                page = version_object(version)
             except (ValueError, models.Version.DoesNotExist):
                 raise Http404('Version not found')
 
@@ -70,68 +306,161 @@ def edit(request, model, object_id):
                                'version': version},
                               context_instance=RequestContext(request))
 
+@conditional(version_validators)
 def version(request, model, object_id):
     """Returns a versioned view of the given instance."""
     try:
         version_id = int(request.GET.get('version_id'))
-        version = (models.Version.objects.get_for_object_reference(model,
-                                                                   object_id)
-                                  .get(id=version_id))
-        instance = version.object_version.object
+        version = get_versions(model, object_id).get(id=version_id)
     except (ValueError, models.Version.DoesNotExist):
         raise Http404('Version not found')
 
+    if wants_json(request):
+        values = utils.serialized_field_data(version)
+        if values is None:
+            # Other formats are deserialized, give the values as stored in
+            #   JSON all the same
+            values = serializers.serialize('python',
+                                           [version_object(version)]
+                                           )[0]['fields']
+        return json_response({'object_id': object_id,
+                              'version': version_json(version),
+                              'fields': values})
+
+    instance = version_object(version)
+
     return render_to_response('wikify/version.html',
                               {'instance': instance,
-                               'fields': list(utils.model_field_iterator(
-                                                                     instance)),
+                               'fields': utils.ModelFields(instance),
                                'version': version},
                               context_instance=RequestContext(request))
 
+@conditional(versions_validators)
 def versions(request, model, object_id, paginate=20):
-    """Returns a paginated list of all versions of the given instance."""
-
-    all_versions = (models.Version.objects.get_for_object_reference(model,
-                                                                    object_id)
-                                   .reverse()
-                                   .select_related("revision"))
-    p = paginator.Paginator(all_versions, paginate)
-    page_no = request.GET.get('page', 1)
-    try:
-        versions = p.page(page_no)
-    except paginator.PageNotAnInteger:
-        versions = p.page(1)
-    except paginator.EmptyPage:
-        versions = p.page(p.num_pages)
+    """
+    Returns a paginated list of all versions of the given instance.
+
+    Pages are selected by version id (using 'before' or 'after' parameters)
+    instead of by page number, if WIKIFY_CURSOR_PAGINATION is set or either
+    parameter is given. This saves counting all versions and stays fast for
+    old versions of long histories.
+    """
+
+    all_versions = get_versions(model, object_id)
+
+    if (getattr(settings, 'WIKIFY_CURSOR_PAGINATION', False)
+        or 'before' in request.GET or 'after' in request.GET):
+        try:
+            before = int(request.GET.get('before') or 0) or None
+            after = int(request.GET.get('after') or 0) or None
+        except ValueError:
+            before = after = None
+        versions = cursor_page(all_versions, paginate, before=before,
+                               after=after)
+    else:
+        p = paginator.Paginator(all_versions.reverse(), paginate)
+        page_no = request.GET.get('page', 1)
+        try:
+            versions = p.page(page_no)
+        except paginator.PageNotAnInteger:
+            versions = p.page(1)
+        except paginator.EmptyPage:
+            versions = p.page(p.num_pages)
+
+    if wants_json(request):
+        data = {'object_id': object_id,
+                'versions': [version_json(version)
+                             for version in versions.object_list]}
+        if getattr(versions, 'cursor', False):
+            data.update(next_before=versions.next_before,
+                        previous_after=versions.previous_after)
+        else:
+            data.update(page=versions.number,
+                        num_pages=versions.paginator.num_pages)
+        return json_response(data)
 
     return render_to_response('wikify/versions.html',
                               {'object_id': object_id,
                                'versions': versions},
                               context_instance=RequestContext(request))
 
+@conditional(diff_validators)
 def diff(request, model, object_id):
     """Returns the difference between the given version and the previous one."""
 
-    versions = models.Version.objects.get_for_object_reference(model, object_id)
     try:
         version_id = int(request.GET.get('version_id'))
-        # Get version and make sure it belongs to the given page
-        new_version = versions.get(id=version_id)
+        # Get version and make sure it belongs to the given page, the next
+        #   version is needed for a link
+        old_version, new_version, next_version = (
+                      utils.get_version_with_neighbours(
+                                  get_versions(model, object_id), version_id))
     except (ValueError, models.Version.DoesNotExist):
         raise Http404("Version not found")
 
-    old_version_q = versions.filter(id__lt=version_id).reverse()
-    old_version = old_version_q[0] if old_version_q else None
-
-    # Get the next version so we can provide a link
-    next_version_q = versions.filter(id__gt=version_id)
-    next_version = next_version_q[0] if next_version_q else None
+    fields = utils.VersionFields(model, old_version, new_version)
+    if wants_json(request):
+        return json_response(diff_data(object_id, old_version, new_version,
+                                       next_version, fields.changed()))
 
     context = {'old_version': old_version,
                'new_version': new_version,
-               'fields': list(utils.version_field_iterator(old_version,
-                                                           new_version)),
+               'fields': fields,
+               'changed_fields': fields.changed(),
                'next_version': next_version}
+    if getattr(settings, 'WIKIFY_STREAM_DIFFS', False):
+        return StreamingHttpResponse(stream_diff(request, context))
     return render_to_response('wikify/diff.html',
                               context,
                               context_instance=RequestContext(request))
+
+def diff_data(object_id, old_version, new_version, next_version,
+              changed_fields):
+    """
+    Returns the diff of the changed fields for JSON output. Each field has a
+    list of hunks [old line index, new line index, lines], with each line a
+    pair of old and new spans (see wikify.diff_utils.context_hunks).
+    """
+    # Diffing needs diff_match_patch, don't require it for the other views
+    from wikify.cache import cached_context_diff, diff_cache_key
+
+    fields = []
+    for field, old_value, new_value in changed_fields:
+        hunks, degraded = cached_context_diff(
+                            force_unicode(old_value) if old_value else '',
+                            force_unicode(new_value) if new_value else '',
+                            key=diff_cache_key(old_version, new_version,
+                                               field.name),
+                            spans=True)
+        fields.append({'name': field.name,
+                       'degraded': degraded,
+                       'hunks': list(hunks)})
+    return {'object_id': object_id,
+            'old_version': version_json(old_version),
+            'new_version': version_json(new_version),
+            'next_version_id': next_version.id if next_version else None,
+            'fields': fields}
+
+def stream_diff(request, context):
+    """
+    Renders the diff page piece by piece, so rows are sent as soon as they are
+    calculated instead of holding the whole page in memory.
+    """
+    # Diffing needs diff_match_patch, don't require it for the other views
+    from wikify.cache import diff_cache_key
+    from wikify.templatetags.diff import context_diff_rows
+
+    context_instance = RequestContext(request)
+    page = render_to_string('wikify/diff.html',
+                            dict(context, stream_rows_marker=STREAM_ROWS_MARKER),
+                            context_instance=context_instance)
+    parts = page.split(STREAM_ROWS_MARKER)
+    yield parts[0]
+    for (field, old_value, new_value), part in zip(context['changed_fields'],
+                                                    parts[1:]):
+        cache_key = diff_cache_key(context['old_version'],
+                                   context['new_version'], field.name)
+        for rows in context_diff_rows(old_value, new_value, context_instance,
+                                      cache_key=cache_key):
+            yield rows
+        yield part